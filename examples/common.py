@@ -55,10 +55,11 @@ def initlog(log_file):
         handler.setFormatter(logging.Formatter(fmt))
         logger.addHandler(handler)
 
+pool = ClientPool()
+
 def connect(username, password):
-        client = RavelloClient()
         try:
-                client.login(username, password)
+                client = pool.get(username, password)
         except Exception as e:
                 sys.stderr.write('Error: {!s}\n'.format(e))
                 print('Error: Invalid user credentials, username {0}'.format(username))
@@ -1,57 +1,244 @@
-# A Ravello SDK example for enforcing a short auto-stop for all published applications 
+# A Ravello SDK example for enforcing a short auto-stop for all published applications
 # in the account
-# 
-# To use, edit the relevant variables (or extract them to command line param),
-# and run enforce_autostop()
+#
+# To use, edit the relevant variables (or pass them as command line options),
+# and run enforce_autostop(), or run this file with --continuous to keep
+# enforcing the policy.
 #
 # Copyright 2011-2015 Ravello Systems, Inc.
-# 
+#
 # Licensed under the Apache License, Version 2.0 (the "License"); you may not
 # use this file except in compliance with the License.  You may obtain a copy
 # of the License at
-# 
+#
 #    http://www.apache.org/licenses/LICENSE-2.0
-# 
+#
 # Unless required by applicable law or agreed to in writing, software
 # distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
 # License for the specific language governing permissions and limitations under
 # the License.
 
+from __future__ import absolute_import, print_function
+
+import time
+import fnmatch
+import logging
+
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 from ravello_sdk import *
-import datetime
 
 MAX_ALLOWED_EXPIRATION_PERIOD_IN_SEC = 60*60*2 # 2 hours
 USERNAME = 'wile.e.coyote@acme.com'
 PASSWORD = 'PA$$W0RD'
 
-def enforce_autostop():
-    client = RavelloClient()
-    client.login(USERNAME, PASSWORD)
-    
-    apps = client.get_applications()
+# Per-application rules, as (name pattern, max expiration period in seconds).
+# The first matching rule wins. Applications that do not match any rule get
+# MAX_ALLOWED_EXPIRATION_PERIOD_IN_SEC.
+EXPIRATION_RULES = []
+
+# Applications that expire at most this many seconds later than allowed are
+# considered compliant. This avoids resetting the expiration of applications
+# because of clock skew.
+TOLERANCE_IN_SEC = 60
+
+log = logging.getLogger('enforce_autostop')
+
+def max_expiration(app, rules=None):
+    """Return the maximum allowed expiration period for *app*."""
+    for pattern, seconds in rules or EXPIRATION_RULES:
+        if fnmatch.fnmatchcase(app['name'], pattern):
+            return seconds
+    return MAX_ALLOWED_EXPIRATION_PERIOD_IN_SEC
+
+def is_running(app):
+    """Return whether *app* is published and has active VMs.
+
+    This only uses the fields that are present in the application listing.
+    """
+    if not app.get('published'):
+        return False
+    return app.get('deployment', {}).get('totalActiveVms', 0) > 0
+
+def should_expire_app(app, max_seconds, now, tolerance=TOLERANCE_IN_SEC):
+    """Return whether the expiration of *app* needs to be set.
+
+    The *now* argument is the current time in seconds since the epoch.
+    """
+    if 'nextStopTime' not in app:
+        # no expiration set for this application, set it
+        return True
+    remaining = app['nextStopTime'] / 1e3 - now
+    return remaining > max_seconds + tolerance
+
+def evaluate(apps, now, rules=None, tolerance=TOLERANCE_IN_SEC):
+    """Evaluate the expiration policy against an application listing.
+
+    Return a list of ``(app, seconds)`` tuples for the applications whose
+    expiration needs to be set.
+    """
+    actions = []
     for app in apps:
-        if app['published'] == False:
-            continue
-        deployment = app['deployment']
-        if deployment['totalActiveVms'] == 0:
+        if not is_running(app):
             continue
-        if not app.has_key('nextStopTime'):
-            # no expiration set for this application, set it
-            set_expiration(client, app)
-        else:
-            expiration_time = datetime.datetime.utcfromtimestamp(app['nextStopTime'] / 1e3)
-            # if expiration_time (utc) is too long into the future, set_expiration correctly
-            if should_expire_app(expiration_time, app):
-                set_expiration(client, app)
-
-def should_expire_app(current_expiration_time_utc, app):
-    now = datetime.datetime.utcnow()
-    delta = current_expiration_time_utc - now
-    if delta.total_seconds() > MAX_ALLOWED_EXPIRATION_PERIOD_IN_SEC:
+        max_seconds = max_expiration(app, rules)
+        if should_expire_app(app, max_seconds, now, tolerance):
+            actions.append((app, max_seconds))
+    return actions
+
+def set_expiration(client, app, seconds=MAX_ALLOWED_EXPIRATION_PERIOD_IN_SEC):
+    log.info('setting expiration for {0}'.format(app['name']))
+    client.set_application_expiration(app, {'expirationFromNowSeconds': seconds})
+    # Keep the listing entry in line with the expiration that was applied.
+    app['nextStopTime'] = int((time.time() + seconds) * 1e3)
+
+def apply_actions(client, actions, parallel=8, dry_run=False):
+    """Set the expiration for the applications in *actions*.
+
+    The calls are made concurrently with at most *parallel* outstanding
+    requests. Return the number of failures.
+    """
+    if dry_run:
+        for app, seconds in actions:
+            log.info('dry-run, would set expiration for {0}'.format(app['name']))
+        return 0
+    def apply1(action):
+        try:
+            set_expiration(client, *action)
+        except Exception as e:
+            log.error('could not set expiration for {0}: {1!s}'.format(action[0]['name'], e))
+            return False
         return True
-    return False
+    with ThreadPoolExecutor(max(1, parallel)) as executor:
+        return list(executor.map(apply1, actions)).count(False)
+
+def enforce_autostop(client=None, parallel=8, dry_run=False):
+    """Enforce the expiration policy once. Return the listing."""
+    if client is None:
+        client = RavelloClient()
+        client.login(USERNAME, PASSWORD)
+    apps = client.get_applications()
+    actions = evaluate(apps, time.time())
+    apply_actions(client, actions, parallel, dry_run)
+    return apps
+
+class TimerWheel(object):
+    """A hashed timer wheel.
+
+    The wheel has *nslots* slots of *resolution* seconds each. Timers that are
+    further out than one rotation are kept in their slot until the wheel has
+    turned far enough. Scheduling and cancelling a timer are O(1).
+    """
+
+    def __init__(self, resolution=60, nslots=512):
+        self.resolution = resolution
+        self.slots = [set() for i in range(nslots)]
+        self.timers = {}
+        self.current = None
+
+    def _tick(self, when):
+        return int(when // self.resolution)
+
+    def schedule(self, key, when):
+        """Schedule a timer for *key* at time *when*, replacing any existing one."""
+        self.cancel(key)
+        tick = self._tick(when)
+        if self.current is not None:
+            tick = max(tick, self.current)
+        self.slots[tick % len(self.slots)].add(key)
+        self.timers[key] = tick
+
+    def cancel(self, key):
+        """Cancel the timer for *key*, if any."""
+        tick = self.timers.pop(key, None)
+        if tick is not None:
+            self.slots[tick % len(self.slots)].discard(key)
+
+    def advance(self, now):
+        """Advance the wheel to time *now*. Return the keys that are due."""
+        target = self._tick(now)
+        if self.current is None:
+            self.current = target
+        start = self.current
+        if target - start >= len(self.slots):
+            start = target - len(self.slots) + 1
+        due = []
+        for tick in range(start, target + 1):
+            slot = self.slots[tick % len(self.slots)]
+            expired = [key for key in slot if self.timers[key] <= target]
+            for key in expired:
+                slot.discard(key)
+                del self.timers[key]
+            due.extend(expired)
+        self.current = target
+        return due
+
+    def next_due(self):
+        """Return the time at which the first timer is due, or None."""
+        if not self.timers:
+            return None
+        return min(self.timers.values()) * self.resolution
+
+def recheck(client, app_ids, parallel=8, dry_run=False):
+    """Reload the applications in *app_ids* and enforce the expiration policy
+    on them. The applications are reloaded with a single listing request.
+    Return the applications that still exist."""
+    app_ids = set(app_ids)
+    apps = [app for app in client.get_applications() if app['id'] in app_ids]
+    actions = evaluate(apps, time.time())
+    apply_actions(client, actions, parallel, dry_run)
+    return apps
+
+def run_continuously(client, interval=300, parallel=8, dry_run=False):
+    """Keep enforcing the expiration policy.
+
+    The application listing is evaluated every *interval* seconds. Compliant
+    applications are put on a timer wheel keyed on their ``nextStopTime``.
+    When a timer is due, the application is reloaded and evaluated again, so
+    that an application whose expiration was extended beyond the policy is
+    caught when it is due rather than at the next interval. Applications
+    whose expiration was reset are rescheduled from the new expiration.
+    """
+    wheel = TimerWheel()
+    wheel.advance(time.time())
+    next_listing = 0
+    apps = []
+    while True:
+        now = time.time()
+        if now >= next_listing:
+            apps = enforce_autostop(client, parallel, dry_run)
+            next_listing = now + interval
+        for app in apps:
+            stop_time = app.get('nextStopTime', 0) / 1e3
+            if is_running(app) and stop_time > now:
+                wheel.schedule(app['id'], stop_time + TOLERANCE_IN_SEC)
+            else:
+                wheel.cancel(app['id'])
+        wakeup = next_listing
+        due = wheel.next_due()
+        if due is not None and due < wakeup:
+            wakeup = due
+        time.sleep(max(wakeup - time.time(), 1))
+        due = wheel.advance(time.time())
+        apps = recheck(client, due, parallel, dry_run) if due else []
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('-u', '--username', default=USERNAME)
+    parser.add_argument('-p', '--password', default=PASSWORD)
+    parser.add_argument('-n', '--dry-run', action='store_true')
+    parser.add_argument('-j', '--parallel', type=int, default=8)
+    parser.add_argument('-c', '--continuous', action='store_true')
+    parser.add_argument('-i', '--interval', type=int, default=300)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s %(message)s')
+    client = RavelloClient()
+    client.login(args.username, args.password)
+    if args.continuous:
+        run_continuously(client, args.interval, args.parallel, args.dry_run)
+    else:
+        enforce_autostop(client, args.parallel, args.dry_run)
 
-def set_expiration(client, app):
-    print "setting expiration for ", app['name']
-    client.set_application_expiration(app, {'expirationFromNowSeconds': MAX_ALLOWED_EXPIRATION_PERIOD_IN_SEC})
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,9 @@
 #!/usr/bin/env python3
 #
 # startstop.py: example program that start and stops applications that do not
-# need to run all the time. The program needs to be run from cron, and expects
-# a configuration file in ~/.startstop/config.js.
+# need to run all the time. The program needs to be run from cron, or as a
+# daemon with --daemon, and expects a configuration file in
+# ~/.startstop/config.js.
 #
 # Copyright 2012-2014 Ravello Systems, Inc.
 # 
@@ -27,13 +28,20 @@ import logging.handlers
 import errno
 import json
 import textwrap
+import time
+import bisect
+import heapq
 
 from argparse import ArgumentParser
-from datetime import datetime
+from datetime import datetime, timedelta
 from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
 from ravello_sdk import *
 
 log = logging.getLogger('main')
+minutes_per_week = 7 * 24 * 60
+reload_interval = 10
+retry_interval = timedelta(minutes=1)
 example_cfg = textwrap.dedent("""\
     {
       "expire": 1440,
@@ -71,6 +79,10 @@ def mkparser():
     parser.add_argument('-d', '--debug', action='store_true')
     parser.add_argument('-l', '--log-file', action='store_true')
     parser.add_argument('-n', '--dry-run', action='store_true')
+    parser.add_argument('-D', '--daemon', action='store_true',
+                        help='keep running and act on transitions as they are due')
+    parser.add_argument('-j', '--parallel', type=int, default=8,
+                        help='number of applications to process concurrently')
     return parser
 
 def initapp(args):
@@ -115,9 +127,13 @@ def readcfg():
         cfg = json.load(fin)
     return cfg
 
+def minute_of_week(now):
+    """Return the minute of the week of *now*."""
+    return now.weekday() * 24 * 60 + now.hour * 60 + now.minute
+
 def active(intervals, now):
-    """Return True if the minute of the week of *dt* is in *intervals*."""
-    mow = now.weekday() * 24 * 60 + now.hour * 60 + now.minute
+    """Return True if the minute of the week of *now* is in *intervals*."""
+    mow = minute_of_week(now)
     for start,end in intervals:
         if start <= mow < end:
             return True
@@ -130,59 +146,163 @@ def connect(username, password):
     client.login(username, password)
     return client
 
-def startstop(cfg, req, now, dry_run):
-    """Start or stop an application, if needed."""
+def timeline(intervals):
+    """Compile *intervals* into a sorted list of transition points.
+
+    The transition points are the minutes of the week at which the target
+    state of an application may change.
+    """
+    points = set()
+    for start,end in intervals:
+        points.add(start % minutes_per_week)
+        points.add(end % minutes_per_week)
+    return sorted(points)
+
+def next_transition(points, now):
+    """Return the time of the first transition in *points* after *now*."""
+    if not points:
+        return None
+    mow = minute_of_week(now)
+    ix = bisect.bisect_right(points, mow)
+    if ix < len(points):
+        delta = points[ix] - mow
+    else:
+        delta = minutes_per_week - mow + points[0]
+    return now.replace(second=0, microsecond=0) + timedelta(minutes=delta)
+
+def transition(client, cfg, req, now, dry_run):
+    """Start or stop an application, if needed.
+
+    Return True on success, False on failure, and None if an action is
+    already in progress and the application needs to be checked again later.
+    """
+    app = client.get_application(req['id'])
+    if app is None:
+        log.error('no such application: {}'.format(req['id']))
+        return False
+    status = application_state(app)
+    target = 'STARTED' if active(req['active'], now) else 'STOPPED'
+    log.info('need transition from {} => {}'.format(status, target))
+    if not isinstance(status, list):
+        status = [status]
+    if status == [target]:
+        log.info('no action needed')
+    elif dry_run:
+        log.info('dry-run, not making any changes')
+    elif 'STARTING' in status or 'STOPPING' in status:
+        log.info('action in progress, not making any changes')
+        return None
+    elif target == 'STARTED' and 'STOPPED' in status:
+        exp = {'expirationFromNowSeconds': 60*cfg['expire']}
+        client.set_application_expiration(app['id'], exp)
+        client.start_application(app['id'])
+        log.info('application started')
+    elif target == 'STOPPED' and 'STARTED' in status:
+        client.stop_application(app['id'])
+        log.info('application stopped')
+    else:
+        log.error('don\'t know how to get from {} to {}'.format(status, target))
+        return False
+    return True
+
+def startstop(cfg, req, now, dry_run, clients=None):
+    """Start or stop an application, if needed.
+
+    If *clients* is provided, it must be a :class:`ClientPool` and the client
+    is taken from it. Otherwise a new client is used.
+    """
+    if clients is not None:
+        client = clients.get(req['username'], req['password'])
+        return transition(client, cfg, req, now, dry_run)
     client = connect(req['username'], req['password'])
     with closing(client):
-        app = client.get_application(req['id'])
-        if app is None:
-            log.error('no such application: {}'.format(app['id']))
-            return False
-        status = application_state(app)
-        target = 'STARTED' if active(req['active'], now) else 'STOPPED'
-        log.info('need transition from {} => {}'.format(status, target))
-        if not isinstance(status, list):
-            status = [status] 
-        if status == [target]:
-            log.info('no action needed')
-        elif dry_run:
-            log.info('dry-run, not making any changes')
-        elif 'STARTING' in status or 'STOPPING' in status:
-            log.info('action in progress, not making any changes')
-        elif target == 'STARTED' and 'STOPPED' in status:
-            exp = {'expirationFromNowSeconds': 60*cfg['expire']}
-            client.set_application_expiration(app['id'], exp)
-            client.start_application(app['id'])
-            log.info('application started')
-        elif target == 'STOPPED' and 'STARTED' in status:
-            client.stop_application(app['id'])
-            log.info('application stopped')
+        return transition(client, cfg, req, now, dry_run)
+
+def process(cfg, req, now, args, clients=None):
+    """Process one application, logging the outcome."""
+    log.info('processing: {} (id = {})'.format(req['name'], req['id']))
+    try:
+        success = startstop(cfg, req, now, args.dry_run, clients)
+    except Exception as e:
+        if args.debug:
+            log.exception('uncaught exception')
         else:
-            log.error('don\'t know how to get from {} to {}'.format(status, target))
-            return False
-    return True
+            log.error(str(e))
+        success = False
+    if success:
+        log.info('success: {}'.format(req['name']))
+    elif success is None:
+        log.info('pending: {}'.format(req['name']))
+    else:
+        log.error('failure: {}'.format(req['name']))
+    return success
+
+def daemon(args):
+    """Run as a daemon.
+
+    Every application's intervals are compiled into a timeline, and the next
+    transition of each application is kept in a heap. The daemon sleeps until
+    the first transition is due, and then processes all due applications
+    concurrently. Applications that fail or have an action in progress are
+    retried after a minute. The configuration file is reloaded when it
+    changes, after which all applications are processed again.
+    """
+    cfgname = appfile('config.js')
+    clients = ClientPool(refresh=3600)
+    executor = ThreadPoolExecutor(max(1, args.parallel))
+    mtime = cfg = None
+    queue = []
+    try:
+        while True:
+            now = datetime.utcnow()
+            try:
+                st_mtime = os.stat(cfgname).st_mtime
+                if st_mtime != mtime:
+                    newcfg = readcfg()
+                    reqs = newcfg['applications']
+                    timelines = [timeline(req['active']) for req in reqs]
+                    cfg, mtime = newcfg, st_mtime
+                    log.info('loaded configuration: {} applications'.format(len(reqs)))
+                    queue = [(now, ix) for ix in range(len(reqs))]
+            except (OSError, IOError, ValueError, KeyError) as e:
+                if cfg is None:
+                    raise
+                log.error('could not reload configuration: {!s}'.format(e))
+            due = []
+            while queue and queue[0][0] <= now:
+                due.append(heapq.heappop(queue)[1])
+            if due:
+                reqs = cfg['applications']
+                process1 = lambda ix: process(cfg, reqs[ix], now, args, clients)
+                for ix, success in zip(due, list(executor.map(process1, due))):
+                    if success:
+                        when = next_transition(timelines[ix], now)
+                    else:
+                        when = now + retry_interval
+                    if when is not None:
+                        heapq.heappush(queue, (when, ix))
+            wakeup = now + timedelta(seconds=reload_interval)
+            if queue and queue[0][0] < wakeup:
+                wakeup = queue[0][0]
+            delay = (wakeup - datetime.utcnow()).total_seconds()
+            if delay > 0:
+                time.sleep(delay)
+    finally:
+        executor.shutdown()
+        clients.close()
 
 def main():
     parser = mkparser()
     args = parser.parse_args()
     initapp(args)
     initlog(args)
+    if args.daemon:
+        daemon(args)
+        return
     cfg = readcfg()
     now = datetime.utcnow()
     for req in cfg['applications']:
-        log.info('processing: {} (id = {})'.format(req['name'], req['id']))
-        try:
-            success = startstop(cfg, req, now, args.dry_run)
-        except Exception as e:
-            if args.debug:
-                log.exception('uncaught exception')
-            else:
-                log.error(str(e))
-            success = False
-        if success:
-            log.info('success: {}'.format(req['name']))
-        else:
-            log.error('failure: {}'.format(req['name']))
+        process(cfg, req, now, args)
 
 if __name__ == '__main__':
     try:
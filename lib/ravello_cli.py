@@ -17,14 +17,17 @@ from __future__ import absolute_import, print_function
 import os
 import re
 import sys
+import csv
 import logging
 import socket
+import struct
+import fnmatch
 import six
 
 from getpass import getpass
-from six.moves import reduce
+from concurrent.futures import ThreadPoolExecutor
 
-from ravello_sdk import RavelloClient, RavelloError
+from ravello_sdk import RavelloClient, RavelloError, NameAllocator, SessionStore
 
 
 common_options = """\
@@ -197,31 +200,30 @@ def expand_multival_arg(args, name, count):
 def mac_aton(s):
     """Convert a Mac address to an integer."""
     try:
-        mac = list(map(lambda x: int(x, 16), s.split(':')))
-        mac = reduce(lambda a,b: a+b, [mac[i] << (5-i)*8 for i in range(6)])
-    except (ValueError, IndexError):
+        a, b, c, d, e, f = [int(x, 16) for x in s.split(':')]
+    except ValueError:
         raise ValueError('illegal Mac: {0}'.format(s))
-    return mac
+    return (a << 40) | (b << 32) | (c << 24) | (d << 16) | (e << 8) | f
 
 
 def mac_ntoa(i):
     """Convert an int to a mac address."""
-    return ':'.join(map(lambda x: '%02x'%x, [(i >> (5-j)*8) & 0xff for j in range(6)]))
+    h = '{0:012x}'.format(i & 0xffffffffffff)
+    return ':'.join((h[0:2], h[2:4], h[4:6], h[6:8], h[8:10], h[10:12]))
 
 
 def inet_aton(s):
     """Convert a dotted-quad to an int."""
     try:
-        addr = list(map(int, s.split('.')))
-        addr = reduce(lambda a,b: a+b, [addr[i] << (3-i)*8 for i in range(4)])
-    except (ValueError, IndexError):
+        a, b, c, d = [int(x) for x in s.split('.')]
+    except ValueError:
         raise ValueError('illegal IP: {0}'.format(s))
-    return addr
+    return (a << 24) | (b << 16) | (c << 8) | d
 
 
 def inet_ntoa(i):
     """Convert an int to dotted quad."""
-    return '.'.join(map(str, [(i >> (3-j)*8) & 0xff for j in range(4)]))
+    return socket.inet_ntoa(struct.pack('!I', i & 0xffffffff))
 
 
 def parse_cidr(network):
@@ -239,6 +241,88 @@ def parse_cidr(network):
     return inet_ntoa(network), inet_ntoa(netmask)
 
 
+class AddressPool(object):
+    """A pool of integer addresses (IP or Mac) in the range *first* to *last*
+    inclusive.
+
+    Addresses that are already in use can be excluded with :meth:`reserve`.
+    Addresses are then handed out in ascending order by :meth:`allocate`. Both
+    methods work on blocks of addresses, and the search for free addresses is
+    done on a bitmap so that it runs in C.
+    """
+
+    def __init__(self, first, last):
+        if last < first:
+            raise ValueError('empty address range')
+        self.first = first
+        self.last = last
+        self._used = bytearray(last - first + 1)
+        self._navail = len(self._used)
+        self._next = 0
+
+    @property
+    def available(self):
+        """The number of addresses that are still available."""
+        return self._navail
+
+    def reserve(self, addrs):
+        """Mark the addresses in *addrs* as used. Addresses outside the pool
+        are ignored."""
+        used, first, size = self._used, self.first, len(self._used)
+        for addr in addrs:
+            ix = addr - first
+            if 0 <= ix < size and not used[ix]:
+                used[ix] = 1
+                self._navail -= 1
+
+    def allocate(self, count):
+        """Allocate *count* addresses, and return them as a list.
+
+        A ValueError is raised if the pool does not have enough available
+        addresses. In that case nothing is allocated.
+        """
+        if count > self._navail:
+            raise ValueError('address pool exhausted: {0} requested, {1} available'
+                             .format(count, self._navail))
+        used, first, find = self._used, self.first, self._used.find
+        result = []
+        ix = self._next
+        for i in range(count):
+            ix = find(b'\0', ix)
+            used[ix] = 1
+            result.append(first + ix)
+        self._next = ix
+        self._navail -= count
+        return result
+
+
+def get_design_addresses(design):
+    """Return the Mac and IP addresses used by the VMs in *design*.
+
+    The return value is a tuple ``(macs, ips)`` of sets of integers. Automatic
+    Mac addresses and dynamic IP addresses without a reservation are not
+    included.
+    """
+    macs, ips = set(), set()
+    for vm in design.get('vms', []):
+        for conn in vm.get('networkConnections', []):
+            mac = conn.get('device', {}).get('mac')
+            if mac:
+                try:
+                    macs.add(mac_aton(mac))
+                except ValueError:
+                    pass
+            ipcfg = conn.get('ipConfig', {})
+            for ip in (ipcfg.get('staticIpConfig', {}).get('ip'),
+                       ipcfg.get('autoIpConfig', {}).get('reservedIp')):
+                if ip:
+                    try:
+                        ips.add(inet_aton(ip))
+                    except ValueError:
+                        pass
+    return macs, ips
+
+
 def getservbyport(port):
     """Like socket.getservbyport() but return a descriptive string if the
     service is not found."""
@@ -271,9 +355,24 @@ def setup_logger(debug):
 
 # API methods
 
+def get_session_store():
+    """Return the session store configured in $RAVELLO_SESSION_STORE.
+
+    The variable can be set to a directory, or to "keyring" to store sessions
+    in the OS keyring. If it is not set, None is returned and sessions are not
+    stored.
+    """
+    value = os.environ.get('RAVELLO_SESSION_STORE')
+    if not value:
+        return None
+    elif value == 'keyring':
+        return SessionStore(use_keyring=True)
+    return SessionStore(value)
+
+
 def create_client(args):
     """Connect to the Ravello API and return a connection."""
-    client = RavelloClient()
+    client = RavelloClient(session_store=get_session_store())
     if args['password'] is None:
         args['password'] = getpass('Enter password for {0}: '.format(args['username']))
     client.connect()
@@ -324,13 +423,284 @@ def get_keypair(client, name_or_id):
     return client.reload(keypairs[0])
 
 
-def new_name(prefix, existing):
-    """Return a name that starts with *prefix* and is not in *existing*."""
+class DesignIndex(object):
+    """Index over the VMs in an application design.
+
+    The index is built once, with a single pass over the VMs, after which VMs
+    can be looked up by ID, name or host name in constant time. IDs are
+    integers in the API but are usually specified as strings on the command
+    line; both are accepted.
+    """
+
+    def __init__(self, app):
+        design = app.get('design', app)
+        self.vms = design.get('vms') or []
+        self.by_id = {}
+        self.by_name = {}
+        self.by_hostname = {}
+        self._position = {}
+        for vm in self.vms:
+            self._position[id(vm)] = len(self._position)
+            if 'id' in vm:
+                self.by_id[int(vm['id'])] = vm
+            self.by_name.setdefault(vm.get('name'), []).append(vm)
+            for hostname in vm.get('hostnames') or []:
+                self.by_hostname.setdefault(hostname, []).append(vm)
+
+    def _unique(self, vms, name):
+        if len(vms) > 1:
+            raise ValueError('{0} vms match name {1!r}'.format(len(vms), name))
+        return vms[0]
+
+    def get(self, name_or_id, numeric=False):
+        """Look up a VM by name, host name or ID, in that order.
+
+        If *numeric* is true, only the ID is considered. Returns None if there
+        is no such VM, and raises ValueError if the name is ambiguous.
+        """
+        key = str(name_or_id)
+        if not numeric:
+            for index in (self.by_name, self.by_hostname):
+                if key in index:
+                    return self._unique(index[key], key)
+        if key.isdigit():
+            return self.by_id.get(int(key))
+
+    def __getitem__(self, name_or_id):
+        vm = self.get(name_or_id)
+        if vm is None:
+            raise KeyError(name_or_id)
+        return vm
+
+    def __contains__(self, name_or_id):
+        return self.get(name_or_id) is not None
+
+    def __len__(self):
+        return len(self.vms)
+
+    def select(self, pattern, regex=False):
+        """Return the VMs that match *pattern*. See :func:`match_objects`.
+
+        Patterns without wildcards are resolved through the index, with the
+        same result: all VMs whose name, host name or ID matches, in design
+        order. Unlike :meth:`get`, names do not take precedence.
+        """
+        if not regex and not re_wildcard.search(pattern):
+            vms = self.by_name.get(pattern, []) + self.by_hostname.get(pattern, [])
+            vm = self.by_id.get(int(pattern)) if pattern.isdigit() else None
+            if vm is not None and str(vm.get('id')) == pattern:
+                vms.append(vm)
+            unique = dict((id(vm), vm) for vm in vms)
+            return sorted(unique.values(), key=lambda vm: self._position[id(vm)])
+        return match_objects(self.vms, pattern, regex)
+
+
+def get_design_vm(app, name_or_id, numeric=False):
+    """Get a VM from the design of *app* by name, host name or ID."""
+    vm = DesignIndex(app).get(name_or_id, numeric)
+    if vm is None:
+        raise ValueError('vm not found: {0}'.format(name_or_id))
+    return vm
+
+
+def name_allocator(prefix, existing):
+    """Return a :class:`ravello_sdk.NameAllocator` for names of the form
+    "<prefix>-<number>" that are not in *existing*."""
     if not isinstance(prefix, six.text_type):
         prefix = prefix.decode('ascii')
-    for i in range(len(existing)+1):
-        name = u'{0}-{1}'.format(prefix, i)
-        if name not in existing:
-            break
+    return NameAllocator(existing, u'{0}-'.format(prefix))
+
+
+def new_name(prefix, existing):
+    """Return a name that starts with *prefix* and is not in *existing*.
+
+    The new name is added to *existing*. Use :func:`name_allocator` to
+    generate multiple names.
+    """
+    name = name_allocator(prefix, existing).allocate()
     existing.add(name)
     return name
+
+
+# Bulk operations
+
+def read_targets(fname):
+    """Read a CSV file with "target,value" rows.
+
+    Empty lines and lines starting with "#" are skipped. The value is optional
+    and is None if absent. If *fname* is "-", standard input is read.
+    """
+    fin = sys.stdin if fname == '-' else open(fname)
+    try:
+        targets = []
+        for row in csv.reader(fin):
+            if not row or not row[0].strip() or row[0].startswith('#'):
+                continue
+            value = row[1].strip() if len(row) > 1 and row[1].strip() else None
+            targets.append((row[0].strip(), value))
+    finally:
+        if fin is not sys.stdin:
+            fin.close()
+    return targets
+
+
+re_wildcard = re.compile('[*?[]')
+
+
+def match_objects(objs, pattern, regex=False):
+    """Return the objects in *objs* that match *pattern*.
+
+    An object matches if its name or one of its host names (for VMs) matches
+    *pattern*, either as a shell style wildcard or as a regular expression if
+    *regex* is true, or if its ID is equal to *pattern*.
+    """
+    if regex:
+        match = re.compile('(?:{0})\\Z'.format(pattern)).match
+    else:
+        match = re.compile(fnmatch.translate(pattern)).match
+    return [obj for obj in objs
+            if match(obj.get('name', '')) or str(obj.get('id')) == pattern
+            or any(match(hostname) for hostname in obj.get('hostnames') or [])]
+
+
+def run_concurrently(func, items, parallel):
+    """Call *func* on each item in *items* using at most *parallel* threads.
+
+    The return value is a list with a ``(item, result, exception)`` tuple for
+    each item, in the order of *items*. Exceptions are caught and returned.
+    """
+    def call(item):
+        try:
+            return item, func(item), None
+        except Exception as e:
+            return item, None, e
+    with ThreadPoolExecutor(parallel) as executor:
+        return list(executor.map(call, items))
+
+
+def resolve_image_targets(client, targets, regex=False):
+    """Resolve bulk image targets.
+
+    The *targets* argument must be a list of ``(pattern, value)`` tuples. All
+    images are resolved from a single listing. A list of ``(image, value)``
+    tuples is returned. An image that matches multiple targets gets the value
+    of the last target.
+    """
+    images = client.get_images()
+    resolved = {}
+    order = []
+    for pattern, value in targets:
+        matches = match_objects(images, pattern, regex)
+        if not matches:
+            raise ValueError('no image matches: {0}'.format(pattern))
+        for image in matches:
+            if image['id'] not in resolved:
+                order.append(image['id'])
+            resolved[image['id']] = (image, value)
+    return [resolved[imgid] for imgid in order]
+
+
+def resolve_vm_targets(client, targets, regex=False):
+    """Resolve bulk VM targets.
+
+    The *targets* argument must be a list of ``(pattern, value)`` tuples. The
+    pattern has the form "<application>/<vm>", where the "/<vm>" part may be
+    omitted to select all VMs. All applications are resolved from a single
+    listing. The VMs can only be resolved once the design of the application
+    is loaded, so the return value is a list of ``(application, vmtargets)``
+    tuples, with one entry per application. The *vmtargets* element is a list
+    of ``(pattern, value)`` tuples for the VMs in the application.
+    """
+    apps = client.get_applications()
+    resolved = {}
+    order = []
+    for pattern, value in targets:
+        app_pattern, sep, vm_pattern = pattern.rpartition('/')
+        if not sep:
+            app_pattern, vm_pattern = pattern, '*'
+        matches = match_objects(apps, app_pattern, regex)
+        if not matches:
+            raise ValueError('no application matches: {0}'.format(app_pattern))
+        for app in matches:
+            if app['id'] not in resolved:
+                order.append(app['id'])
+                resolved[app['id']] = (app, [])
+            resolved[app['id']][1].append((vm_pattern, value))
+    return [resolved[appid] for appid in order]
+
+
+def select_design_vms(app, vmtargets, regex=False):
+    """Select the VMs in the design of *app* for *vmtargets*.
+
+    See :func:`resolve_vm_targets`. A list of ``(vm, value)`` tuples is
+    returned. A ValueError is raised if a pattern does not match any VM.
+    """
+    index = DesignIndex(app)
+    selected = {}
+    order = []
+    for pattern, value in vmtargets:
+        matches = index.select(pattern, regex)
+        if not matches:
+            raise ValueError('no vm matches: {0}/{1}'.format(app['name'], pattern))
+        for vm in matches:
+            if id(vm) not in selected:
+                order.append(id(vm))
+            selected[id(vm)] = (vm, value)
+    return [selected[key] for key in order]
+
+
+def bulk_update_images(client, targets, update, parallel):
+    """Update images in bulk.
+
+    The *targets* argument is a list as returned by
+    :func:`resolve_image_targets`. For every image, *update* is called with
+    the image and the value. The images are updated concurrently. Returns the
+    list from :func:`run_concurrently`.
+    """
+    def update_image(target):
+        image, value = target
+        return client.modify_image(image, lambda image: update(image, value))
+    return run_concurrently(update_image, targets, parallel)
+
+
+def bulk_update_vms(client, targets, update, parallel, regex=False, after=None):
+    """Update design VMs in bulk.
+
+    The *targets* argument is a list as returned by
+    :func:`resolve_vm_targets`. For every selected VM, *update* is called with
+    the VM and the value. Each application is updated once, and applications
+    are updated concurrently. If *after* is provided, it is called with every
+    updated application, and its return value is used as the result. Returns
+    the list from :func:`run_concurrently`.
+    """
+    def update_app(target):
+        app, vmtargets = target
+
+        def edit(app):
+            for vm, value in select_design_vms(app, vmtargets, regex):
+                update(vm, value)
+        app = client.modify_application(app, edit)
+        return after(app) if after is not None else app
+    return run_concurrently(update_app, targets, parallel)
+
+
+def get_bulk_targets(args):
+    """Return the bulk targets from the command-line arguments.
+
+    The targets are read from the file in "--csv" if it is set, otherwise they
+    are taken from "<target>", without a value.
+    """
+    if args.get('--csv'):
+        return read_targets(args['--csv'])
+    return [(target, None) for target in args['<target>']]
+
+
+def report_bulk_results(results, what):
+    """Report the results of a bulk update. Returns the exit status."""
+    failed = 0
+    for target, result, exc in results:
+        if exc is not None:
+            sys.stderr.write('Error: {0}: {1!s}\n'.format(target[0]['name'], exc))
+            failed += 1
+    print('Updated {0} of {1} {2}.'.format(len(results) - failed, len(results), what))
+    return 1 if failed else 0
@@ -14,28 +14,57 @@
 
 from __future__ import absolute_import, print_function
 
+import os
 import sys
+import array
 import base64
+import binascii
 import socket
 import logging
 import time
 import json
+import hmac
+import errno
 import random
+import hashlib
+import inspect
+import threading
 import requests
 
+from collections import namedtuple
+from concurrent import futures
+from concurrent.futures import ThreadPoolExecutor
+
 # Python 2.x / 3.x module name differences
 try:
     from urllib import parse as urlparse
 except ImportError:
     import urlparse
 
+# Optional, for storing sessions in the OS keyring.
+try:
+    import keyring
+except ImportError:
+    keyring = None
+
+# Optional, for vectorized fleet reports.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 pyver = sys.version_info[:2]
 if pyver not in [(2, 6), (2, 7)] and pyver < (3, 3):
     raise ImportError('Python 2.6, 2.7 or 3.3+ is required')
 
 
-__all__ = ['random_luid', 'update_luids', 'application_state', 'new_name',
-           'RavelloError', 'RavelloClient']
+__all__ = ['random_luid', 'update_luids', 'clone_with_new_luids', 'application_state',
+           'plan_vm_states', 'VmStatePlan', 'FleetSnapshot', 'FleetVm', 'FleetTable',
+           'new_name', 'NameAllocator', 'fingerprint', 'fingerprint_application',
+           'DesignFingerprint',
+           'RavelloError', 'RavelloConflictError', 'BatchError', 'RavelloClient', 'EditSession',
+           'Batch', 'BatchCall', 'ClientPool', 'ApplicationPool', 'ElasticIpPool', 'SessionStore',
+           'gather', 'as_completed']
 
 http_methods = {'POST': requests.post, 'GET': requests.get, 'PUT': requests.put, 'DELETE': requests.delete}
 DEFAULT_HTTPS_PORT = 443
@@ -57,6 +86,9 @@ def update_luids(obj):
     an application's design must have a unique local ID. When you're adding
     multiple VMs based on the same image, the IDs are copied and you need to
     use this function to ensure the VMs have unique local IDs again.
+
+    The object is updated in place, and is also returned. See
+    :func:`clone_with_new_luids` for a faster way to create multiple copies.
     """
     if isinstance(obj, list):
         return [update_luids(elem) for elem in obj]
@@ -66,8 +98,64 @@ def update_luids(obj):
                 obj['id'] = random_luid()
             elif isinstance(value, (dict, list)):
                 update_luids(value)
-    else:
-        return obj
+    return obj
+
+
+def _collect_luids(obj, luids):
+    # Add all "id" values below *obj* to the set *luids*.
+    if isinstance(obj, list):
+        for elem in obj:
+            _collect_luids(elem, luids)
+    elif isinstance(obj, dict):
+        for key, value in obj.items():
+            if key == 'id':
+                luids.add(value)
+            elif isinstance(value, (dict, list)):
+                _collect_luids(value, luids)
+
+
+def _clone_luids(obj, new_luid):
+    # Return a deep copy of *obj* with "id" keys set by *new_luid*.
+    if isinstance(obj, dict):
+        clone = {}
+        for key, value in obj.items():
+            if key == 'id':
+                clone[key] = new_luid()
+            elif isinstance(value, (dict, list)):
+                clone[key] = _clone_luids(value, new_luid)
+            else:
+                clone[key] = value
+        return clone
+    return [_clone_luids(elem, new_luid) if isinstance(elem, (dict, list)) else elem
+            for elem in obj]
+
+
+def clone_with_new_luids(obj, count=None, exclude=None):
+    """Return a copy of *obj* with new locally unique IDs.
+
+    This is equivalent to a :func:`copy.deepcopy` followed by
+    :func:`update_luids`, but makes only a single pass over *obj*. If *count*
+    is provided, a list of *count* independent copies is returned instead.
+
+    The new IDs are unique across all copies, and are different from all IDs
+    in *obj* and in *exclude*. The latter is typically the design of the
+    application that the copies are added to.
+    """
+    used = set()
+    _collect_luids(obj, used)
+    if exclude is not None:
+        _collect_luids(exclude, used)
+    getrandbits = random.getrandbits
+
+    def new_luid():
+        luid = getrandbits(63)
+        while luid in used:
+            luid = getrandbits(63)
+        used.add(luid)
+        return luid
+    if count is None:
+        return _clone_luids(obj, new_luid)
+    return [_clone_luids(obj, new_luid) for i in range(count)]
 
 
 def application_state(app):
@@ -84,6 +172,309 @@ def application_state(app):
     return states if len(states) > 1 else states[0] if len(states) == 1 else None
 
 
+# For each target state, the VM states that are there or moving there, and
+# the VM states from which the action can be taken.
+_vm_transitions = {
+    'STARTED': (frozenset(['STARTED', 'STARTING', 'RESTARTING']), frozenset(['STOPPED']),
+                'start_application', 'start_vm'),
+    'STOPPED': (frozenset(['STOPPED', 'STOPPING']), frozenset(['STARTED']),
+                'stop_application', 'stop_vm'),
+}
+
+
+class VmStatePlan(namedtuple('VmStatePlan', ('calls', 'skipped', 'blocked'))):
+    """The API calls needed to bring VMs to their target state.
+
+    This is returned by :func:`plan_vm_states`. The *calls* attribute is a
+    list of ``(method, args)`` tuples for :class:`RavelloClient` methods.
+    The *skipped* attribute is a list with the IDs of VMs that are already
+    in, or moving to, their target state. The *blocked* attribute is a dict
+    mapping the IDs of VMs that cannot be acted on now (e.g. because they are
+    in the opposite transition, or in an error state) to their state.
+    """
+
+    def run(self, client, max_concurrency=None):
+        """Make the calls in this plan concurrently using *client*.
+
+        See :meth:`RavelloClient.batch`.
+        """
+        batch = client.batch(max_concurrency)
+        for method, args in self.calls:
+            getattr(batch, method)(*args)
+        return batch.run()
+
+
+def plan_vm_states(app, targets):
+    """Plan the API calls to bring the VMs in *app* to their target state.
+
+    The *app* parameter must be a dict with the ``"deployment"`` aspect, as
+    returned by :meth:`~RavelloClient.get_application`. The *targets*
+    parameter is either a dict mapping VM IDs to target states, or a single
+    target state for all VMs. The supported target states are "STARTED" and
+    "STOPPED".
+
+    VMs that are already in, or moving to, their target state are skipped.
+    If all VMs that are not skipped need the same action, and there are
+    several of them, a single application level call is planned instead of
+    one call per VM. Returns a :class:`VmStatePlan`.
+    """
+    vms = app.get('deployment', {}).get('vms', [])
+    states = dict((vm['id'], vm['state']) for vm in vms)
+    if not isinstance(targets, dict):
+        targets = dict((vmid, targets) for vmid in states)
+    todo = {}
+    skipped = []
+    blocked = {}
+    for vmid, target in targets.items():
+        if isinstance(vmid, dict): vmid = vmid['id']
+        vmid = int(vmid)
+        if target not in _vm_transitions:
+            raise ValueError('unsupported target state: {0}'.format(target))
+        if vmid not in states:
+            raise ValueError('no such vm in deployment: {0}'.format(vmid))
+        done, ready = _vm_transitions[target][:2]
+        if states[vmid] in done:
+            skipped.append(vmid)
+        elif states[vmid] in ready:
+            todo.setdefault(target, []).append(vmid)
+        else:
+            blocked[vmid] = states[vmid]
+    calls = []
+    for target in sorted(todo):
+        done, ready, app_method, vm_method = _vm_transitions[target]
+        vmids = sorted(todo[target])
+        # The application call acts on all VMs, so it can only be used if
+        # every other VM is already in the target state.
+        others = [vmid for vmid in states if vmid not in todo[target]]
+        if len(vmids) > 1 and all(states[vmid] in done for vmid in others):
+            calls.append((app_method, (app['id'],)))
+        else:
+            calls.extend((vm_method, (app['id'], vmid)) for vmid in vmids)
+    return VmStatePlan(calls, sorted(skipped), blocked)
+
+
+FleetVm = namedtuple('FleetVm', ('app_id', 'app_name', 'id', 'name', 'state',
+                                 'public_ips', 'fqdn'))
+
+
+def _deployment_vm(app, vm):
+    public_ips = []
+    fqdn = vm.get('externalFqdn')
+    for conn in vm.get('networkConnections', []):
+        config = conn.get('ipConfig', {})
+        if config.get('publicIp') and config['publicIp'] not in public_ips:
+            public_ips.append(config['publicIp'])
+        if fqdn is None:
+            fqdn = config.get('fqdn')
+    return FleetVm(app['id'], app.get('name'), vm['id'], vm.get('name'), vm.get('state'),
+                   public_ips, fqdn)
+
+
+class FleetSnapshot(object):
+    """An indexed table of the deployed VMs in a set of applications.
+
+    The *apps* parameter must be an iterable of dicts with the
+    ``"deployment"`` aspect, as returned by
+    :meth:`~RavelloClient.get_application`. Each VM is stored as a
+    :class:`FleetVm` tuple with its application, state, public IPs and FQDN,
+    all extracted from the deployment.
+
+    The *vms* attribute is the list of all VMs. The *by_id* attribute maps
+    ``(app_id, vm_id)`` tuples to VMs, and *by_ip* and *by_fqdn* map public
+    IPs and FQDNs to VMs. The *by_state* and *by_application* attributes map
+    states and application IDs to lists of VMs.
+    """
+
+    def __init__(self, apps):
+        self.vms = []
+        self.by_id = {}
+        self.by_ip = {}
+        self.by_fqdn = {}
+        self.by_state = {}
+        self.by_application = {}
+        for app in apps:
+            self.by_application.setdefault(app['id'], [])
+            for vm in app.get('deployment', {}).get('vms', []):
+                self.add(_deployment_vm(app, vm))
+
+    def add(self, vm):
+        """Add the :class:`FleetVm` *vm* to the table."""
+        self.vms.append(vm)
+        self.by_id[vm.app_id, vm.id] = vm
+        for ip in vm.public_ips:
+            self.by_ip[ip] = vm
+        if vm.fqdn:
+            self.by_fqdn[vm.fqdn] = vm
+        self.by_state.setdefault(vm.state, []).append(vm)
+        self.by_application.setdefault(vm.app_id, []).append(vm)
+
+    def __len__(self):
+        return len(self.vms)
+
+    def __iter__(self):
+        return iter(self.vms)
+
+    def states(self):
+        """Return a dict mapping states to the number of VMs in that state."""
+        return dict((state, len(vms)) for state, vms in self.by_state.items())
+
+
+_size_units = {'KB': 1.0 / 1024, 'MB': 1, 'GB': 1024, 'TB': 1024 * 1024}
+
+
+def _size_in_mb(size):
+    if not size:
+        return 0
+    return size.get('value', 0) * _size_units.get(size.get('unit', 'MB'), 1)
+
+
+def _application_charges(billing):
+    charges = {}
+    for entry in billing:
+        total = sum(charge.get('charge', 0) for charge in entry.get('charges', []))
+        charges[entry['appId']] = charges.get(entry['appId'], 0) + total
+    return charges
+
+
+class FleetTable(object):
+    """A columnar table of the deployed VMs in a set of applications.
+
+    The *apps* parameter has the same meaning as for :class:`FleetSnapshot`.
+    The table has one row per VM. The string columns in
+    :attr:`categorical` are dictionary encoded: :attr:`columns` holds an
+    array of integer codes, and :attr:`categories` holds the list of
+    distinct values that the codes index. The numeric columns in
+    :attr:`numeric` hold the number of CPUs, the memory in MB, the total
+    disk size in GB, and the charges. This is the same layout as an Arrow
+    dictionary array.
+
+    The *charges* parameter is a dict mapping application IDs to charges,
+    or a list as returned by :meth:`~RavelloClient.get_billing`. The charges
+    of an application are divided equally over its VMs, so that sums over
+    any grouping add up to the total charges of the applications.
+
+    If *use_numpy* is true, or if it is None and the "numpy" package is
+    available, the columns are NumPy arrays and the aggregations are
+    vectorized. Otherwise the columns are compact :mod:`array` arrays.
+    """
+
+    categorical = ('app', 'vm', 'state', 'cloud', 'region')
+    numeric = (('cpus', 'l'), ('memory', 'l'), ('disk', 'l'), ('charges', 'd'))
+
+    def __init__(self, apps, charges=None, use_numpy=None):
+        if use_numpy is None:
+            use_numpy = numpy is not None
+        elif use_numpy and numpy is None:
+            raise RavelloError('numpy is not available')
+        self.use_numpy = use_numpy
+        if isinstance(charges, list):
+            charges = _application_charges(charges)
+        charges = charges or {}
+        values = dict((name, []) for name, typ in self.numeric)
+        codes = dict((name, []) for name in self.categorical)
+        self.categories = dict((name, []) for name in self.categorical)
+        index = dict((name, {}) for name in self.categorical)
+
+        def encode(name, value):
+            code = index[name].get(value)
+            if code is None:
+                code = index[name][value] = len(self.categories[name])
+                self.categories[name].append(value)
+            codes[name].append(code)
+        for app in apps:
+            deployment = app.get('deployment', {})
+            vms = deployment.get('vms', [])
+            charge = float(charges.get(app['id'], 0)) / len(vms) if vms else 0
+            for vm in vms:
+                encode('app', app.get('name'))
+                encode('vm', vm.get('name'))
+                encode('state', vm.get('state'))
+                encode('cloud', deployment.get('cloud'))
+                encode('region', deployment.get('regionName'))
+                values['cpus'].append(vm.get('numCpus', 0))
+                values['memory'].append(int(_size_in_mb(vm.get('memorySize'))))
+                disk = sum(_size_in_mb(drive.get('size')) for drive in vm.get('hardDrives', []))
+                values['disk'].append(int(disk / 1024))
+                values['charges'].append(charge)
+        self.columns = {}
+        for name in self.categorical:
+            self.columns[name] = self._array(codes[name], 'l')
+        for name, typ in self.numeric:
+            self.columns[name] = self._array(values[name], typ)
+
+    def _array(self, values, typ):
+        if self.use_numpy:
+            return numpy.array(values, dtype=numpy.int64 if typ == 'l' else numpy.float64)
+        return array.array(typ, values)
+
+    def __len__(self):
+        return len(self.columns['app'])
+
+    def column(self, name):
+        """Return column *name* as a list of values."""
+        if name in self.categories:
+            categories = self.categories[name]
+            return [categories[code] for code in self.columns[name]]
+        return list(self.columns[name])
+
+    def _aggregate(self, keys, weights=None):
+        if not isinstance(keys, tuple):
+            keys = (keys,)
+        columns = [self.columns[key] for key in keys]
+        if self.use_numpy:
+            # Combine the codes of the key columns into one code per group.
+            # The codes are compacted after every step, so that they stay
+            # below the number of rows and the bins below are not sparse.
+            codes = columns[0]
+            for key, column in zip(keys[1:], columns[1:]):
+                codes = codes * len(self.categories[key]) + column
+                codes = numpy.unique(codes, return_inverse=True)[1].ravel()
+            groups, first, inverse = numpy.unique(codes, return_index=True,
+                                                  return_inverse=True)
+            totals = numpy.bincount(inverse.ravel(), weights, len(groups))
+            if weights is not None and weights.dtype.kind == 'i':
+                totals = totals.astype(weights.dtype)
+            rows = zip(*[column[first].tolist() for column in columns])
+            totals = dict(zip(rows, totals.tolist()))
+        else:
+            totals = {}
+            if weights is None:
+                for row in zip(*columns):
+                    totals[row] = totals.get(row, 0) + 1
+            else:
+                for row, weight in zip(zip(*columns), weights):
+                    totals[row] = totals.get(row, 0) + weight
+        categories = [self.categories[key] for key in keys]
+        result = {}
+        for row, total in totals.items():
+            key = tuple(names[code] for names, code in zip(categories, row))
+            result[key if len(keys) > 1 else key[0]] = total
+        return result
+
+    def count_by(self, keys):
+        """Return the number of rows per value of the categorical column
+        *keys*, or per combination of values if *keys* is a tuple."""
+        return self._aggregate(keys)
+
+    def sum_by(self, keys, column):
+        """Return the sum of the numeric *column* per value of *keys*. See
+        :meth:`count_by` for the meaning of *keys*."""
+        return self._aggregate(keys, self.columns[column])
+
+    def to_records(self):
+        """Return the table as a NumPy structured array. The categorical
+        columns hold codes."""
+        if numpy is None:
+            raise RavelloError('numpy is not available')
+        dtype = [(name, numpy.int64) for name in self.categorical]
+        dtype += [(name, numpy.int64 if typ == 'l' else numpy.float64)
+                  for name, typ in self.numeric]
+        records = numpy.empty(len(self), dtype=dtype)
+        for name, typ in dtype:
+            records[name] = self.columns[name]
+        return records
+
+
 def new_name(existing, prefix):
     """Return a name that is not in *existing*.
 
@@ -92,19 +483,162 @@ def new_name(existing, prefix):
     the "get all" functions like :meth:`RavelloClient.get_applications` or
     :meth:~RavelloClient.get_blueprints`.
 
-    The unique name is generated by appending a number to *prefix*.
+    The unique name is generated by appending a number to *prefix*. Use a
+    :class:`NameAllocator` to generate multiple names.
     """
-    names = set()
-    for name in existing:
+    return NameAllocator(existing, prefix).allocate()
+
+
+class NameAllocator(object):
+    """Allocate unique names that consist of a prefix and a number.
+
+    The *existing* and *prefix* parameters have the same meaning as for
+    :func:`new_name`. The existing names are parsed once. After that, names
+    are handed out in ascending order of their number, filling the gaps
+    between existing names first. Every allocation takes amortized constant
+    time.
+    """
+
+    def __init__(self, existing, prefix):
+        self.prefix = prefix
+        self._used = set()
+        self._next = 0
+        for name in existing:
+            self.reserve(name)
+
+    def reserve(self, name):
+        """Mark *name* as used. It may be a string or a dict with a "name" key."""
         if isinstance(name, dict):
-            names.add(name['name'])
-        else:
-            names.add(name)
-    for i in range(len(names)+1):
-        name = '{0}{1}'.format(prefix, i)
-        if name not in names:
-            break
-    return name
+            name = name['name']
+        if not name.startswith(self.prefix):
+            return
+        suffix = name[len(self.prefix):]
+        try:
+            number = int(suffix)
+        except ValueError:
+            return
+        # Only the canonical form counts: "vm01" does not reserve "vm1".
+        if str(number) == suffix:
+            self._used.add(number)
+
+    def allocate(self, count=None):
+        """Return a new unique name.
+
+        If *count* is provided, return a list of *count* new unique names.
+        """
+        names = []
+        for i in range(1 if count is None else count):
+            while self._next in self._used:
+                self._used.discard(self._next)
+                self._next += 1
+            names.append('{0}{1}'.format(self.prefix, self._next))
+            self._next += 1
+        return names[0] if count is None else names
+
+
+# Keys that are ignored when fingerprinting. These are either injected by the
+# SDK itself, or are updated by the server without a change to the design.
+fingerprint_ignore = frozenset(['_href', '_etag', 'creationTime', 'lastUpdateTime',
+                                'nextStopTime', 'version', 'validationMessages'])
+
+
+# Keys of a library VM that do not belong in a design VM. The "id" is kept, so
+# that it is replaced with a new LUID along with the other IDs.
+_library_only = frozenset(['_href', '_etag', 'creationTime', 'owner', 'ownerDetails',
+                           'isPublic', 'peerToPeerShares', 'creatorName'])
+
+
+def _digest(obj, ignore, known=None):
+    """Return the binary Merkle digest of *obj*.
+
+    The *known* argument can be a dict mapping ``id(subobj)`` to a digest
+    that was already computed for *subobj*.
+    """
+    if known and id(obj) in known:
+        return known[id(obj)]
+    if isinstance(obj, dict):
+        h = hashlib.sha1(b'd')
+        for key in sorted(obj):
+            if key in ignore:
+                continue
+            h.update(key.encode('utf8'))
+            h.update(b'\0#')
+            h.update(_digest(obj[key], ignore, known))
+        return h.digest()
+    elif isinstance(obj, list):
+        # Lists are ordered. This includes lists of entities, where the order
+        # can matter (e.g. "hardDrives" and "networkConnections").
+        h = hashlib.sha1(b'l')
+        for elem in obj:
+            h.update(b'#')
+            h.update(_digest(elem, ignore, known))
+        return h.digest()
+    return hashlib.sha1(json.dumps(obj).encode('utf8')).digest()
+
+
+def _hexdigest(digest):
+    return binascii.hexlify(digest).decode('ascii')
+
+
+def fingerprint(obj, ignore=None):
+    """Return a stable fingerprint for *obj* as a hex string.
+
+    The object must be a dict, a list, or a scalar as returned by the API.
+    The fingerprint is a Merkle-style hash: it does not depend on the order of
+    keys in a dict, but it does depend on the order of the elements in a list.
+    The keys in *ignore* are skipped at every level. If not provided, it defaults
+    to ``fingerprint_ignore``, which includes the ``"_href"`` key added by the
+    SDK and a few fields that are updated by the server.
+    """
+    if ignore is None:
+        ignore = fingerprint_ignore
+    return _hexdigest(_digest(obj, ignore))
+
+
+class DesignFingerprint(namedtuple('DesignFingerprint', ('digest', 'vms'))):
+    """The fingerprint of an application, as returned by
+    :func:`fingerprint_application`.
+
+    This is a tuple ``(digest, vms)`` where *digest* is the fingerprint of the
+    application and *vms* is a dict mapping the ID of every VM in the design
+    to its fingerprint.
+    """
+
+    __slots__ = ()
+
+    def changed_vms(self, other):
+        """Return the set of VM IDs that differ between *self* and *other*.
+
+        This includes VMs that were added or removed.
+        """
+        changed = set(self.vms) ^ set(other.vms)
+        for vmid, digest in self.vms.items():
+            if vmid in other.vms and other.vms[vmid] != digest:
+                changed.add(vmid)
+        return changed
+
+
+def fingerprint_application(app, ignore=None):
+    """Return the fingerprint of application *app*.
+
+    The *app* parameter must be a dict as returned by
+    :meth:`~RavelloClient.get_application`. The application properties and
+    its design are included in the fingerprint. The deployment is not, as it
+    changes with the run-time state of the VMs.
+
+    The return value is a :class:`DesignFingerprint`. The per-VM digests are
+    computed once and are re-used for the application digest.
+    """
+    if ignore is None:
+        ignore = fingerprint_ignore
+    ignore = ignore | frozenset(['deployment'])
+    known = {}
+    vms = {}
+    for vm in app.get('design', {}).get('vms', []):
+        known[id(vm)] = digest = _digest(vm, ignore)
+        vms[vm.get('id')] = _hexdigest(digest)
+    digest = _hexdigest(_digest(app, ignore, known))
+    return DesignFingerprint(digest, vms)
 
 
 def urlsplit2(url, default_scheme='http'):
@@ -131,6 +665,12 @@ def _idempotent(method):
     return method in ('GET', 'HEAD', 'PUT')
 
 
+def _is_conflict(exc):
+    """Return whether *exc* is an HTTP conflict from a concurrent update."""
+    response = getattr(exc, 'response', None)
+    return response is not None and response.status_code in (409, 412)
+
+
 def _match_filter(obj, flt):
     """Match the object *obj* with filter *flt*."""
 
@@ -160,6 +700,185 @@ class RavelloError(Exception):
     """Exception used by :class:`RavelloClient`."""
 
 
+class RavelloConflictError(RavelloError):
+    """An update failed because the object was modified concurrently."""
+
+
+class BatchError(RavelloError):
+    """One or more calls in a :class:`Batch` failed.
+
+    All calls are available in the *calls* attribute, and the failed ones in
+    *failed*. Each call is a :class:`BatchCall`.
+    """
+
+    max_report = 10
+
+    def __init__(self, calls):
+        self.calls = calls
+        self.failed = [call for call in calls if call.exception is not None]
+        skipped = len([call for call in calls if call.skipped])
+        lines = ['{0} of {1} calls failed'.format(len(self.failed), len(calls))]
+        if skipped:
+            lines[0] += ', {0} skipped'.format(skipped)
+        for call in self.failed[:self.max_report]:
+            lines.append('{0}: {1!s}'.format(call, call.exception))
+        if len(self.failed) > self.max_report:
+            lines.append('...')
+        super(BatchError, self).__init__('\n'.join(lines))
+
+
+def _compare_digest(a, b):
+    """Compare two strings in constant time, if supported."""
+    compare = getattr(hmac, 'compare_digest', None)
+    if compare is None:
+        return a == b
+    return compare(a, b)
+
+
+class SessionStore(object):
+    """A persistent store for authenticated sessions.
+
+    A session is stored after a successful login, and is restored by a new
+    client with the same API URL and credentials instead of logging in again.
+    Sessions are keyed by an HMAC of the URL and username, using a random
+    secret that is kept in the store. A salted PBKDF2 hash of the password is
+    stored with the session, so a session can only be restored by a caller
+    that knows the password.
+
+    By default, sessions are stored as files in *directory* (defaulting to
+    ``~/.ravello/sessions``) that are only accessible by the current user. If
+    *use_keyring* is true, sessions are stored in the OS keyring instead. This
+    requires the "keyring" package.
+    """
+
+    default_directory = os.path.join('~', '.ravello', 'sessions')
+    keyring_service = 'ravello-sdk'
+    hash_iterations = 100000
+
+    def __init__(self, directory=None, use_keyring=False):
+        if use_keyring and keyring is None:
+            raise RuntimeError('the "keyring" package is required to use the keyring')
+        self.directory = os.path.expanduser(directory or self.default_directory)
+        self.use_keyring = use_keyring
+        self._secret = None
+
+    def _makedirs(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, 0o700)
+
+    def _get_secret(self):
+        # Return the local secret, creating it if needed.
+        if self._secret is not None:
+            return self._secret
+        new = binascii.hexlify(os.urandom(32)).decode('ascii')
+        if self.use_keyring:
+            secret = keyring.get_password(self.keyring_service, 'secret')
+            if not secret:
+                keyring.set_password(self.keyring_service, 'secret', new)
+                secret = new
+        else:
+            self._makedirs()
+            path = os.path.join(self.directory, 'secret')
+            try:
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                with open(path) as fin:
+                    if os.name == 'posix' and os.fstat(fin.fileno()).st_mode & 0o077:
+                        raise RuntimeError('session store secret is accessible by others')
+                    secret = fin.read().strip()
+            else:
+                with os.fdopen(fd, 'w') as fout:
+                    fout.write(new)
+                secret = new
+        if not secret:
+            raise RuntimeError('session store secret is empty')
+        self._secret = secret
+        return secret
+
+    def key(self, url, username):
+        """Return the key for a session."""
+        ident = '\0'.join([url, username]).encode('utf8')
+        return hmac.new(self._get_secret().encode('ascii'), ident, hashlib.sha256).hexdigest()
+
+    def _hash_password(self, password, salt):
+        password = password.encode('utf8')
+        if hasattr(hashlib, 'pbkdf2_hmac'):
+            digest = hashlib.pbkdf2_hmac('sha256', password, salt, self.hash_iterations)
+        else:
+            # Python versions before 2.7.8 and 3.4.
+            digest = hmac.new(salt + self._get_secret().encode('ascii'), password,
+                              hashlib.sha256).digest()
+        return binascii.hexlify(digest).decode('ascii')
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def load(self, key, password=None):
+        """Load the session for *key*. Return None if there is no session.
+
+        If *password* is provided, None is also returned if the session was
+        not stored with the same password.
+        """
+        if self.use_keyring:
+            data = keyring.get_password(self.keyring_service, key)
+        else:
+            try:
+                with open(self._path(key)) as fin:
+                    # Do not trust a file that other users could have written.
+                    if os.name == 'posix' and os.fstat(fin.fileno()).st_mode & 0o077:
+                        return None
+                    data = fin.read()
+            except (IOError, OSError):
+                return None
+        try:
+            session = json.loads(data) if data else None
+        except ValueError:
+            return None
+        if password is not None and session is not None:
+            salt = binascii.unhexlify(session.pop('salt', '').encode('ascii'))
+            expected = self._hash_password(password, salt)
+            if not _compare_digest(session.pop('password', ''), expected):
+                return None
+        return session
+
+    def save(self, key, session, password=None):
+        """Store *session* under *key*.
+
+        If *password* is provided, a salted hash of it is stored with the
+        session. See :meth:`load`.
+        """
+        if password is not None:
+            salt = os.urandom(16)
+            session = dict(session, salt=binascii.hexlify(salt).decode('ascii'),
+                           password=self._hash_password(password, salt))
+        data = json.dumps(session)
+        if self.use_keyring:
+            keyring.set_password(self.keyring_service, key, data)
+            return
+        self._makedirs()
+        fname = self._path(key)
+        tmpname = '{0}.{1}.tmp'.format(fname, os.getpid())
+        fd = os.open(tmpname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as fout:
+            fout.write(data)
+        os.rename(tmpname, fname)
+
+    def delete(self, key):
+        """Delete the session for *key*, if any."""
+        if self.use_keyring:
+            try:
+                keyring.delete_password(self.keyring_service, key)
+            except keyring.errors.PasswordDeleteError:
+                pass
+            return
+        try:
+            os.unlink(self._path(key))
+        except OSError:
+            pass
+
+
 class RavelloClient(object):
     """A client for the Ravello API.
 
@@ -200,8 +919,11 @@ class RavelloClient(object):
     default_timeout = 60
     default_retries = 3
     default_redirects = 3
+    default_max_workers = 8
+    max_fingerprints = 1000
 
-    def __init__(self, username=None, password=None, url=None, timeout=None, retries=None, proxy_url=None, eph_token=None):
+    def __init__(self, username=None, password=None, url=None, timeout=None, retries=None,
+                 proxy_url=None, eph_token=None, session_store=None):
         """Create a new client.
 
         The *username* and *password* parameters specify the credentials to use
@@ -210,6 +932,8 @@ class RavelloClient(object):
         of retries respectively.
         *proxy_url* should be used when an HTTP proxy is in place.
         *eph_token* is ephemeral access token to be used instead of username/password.
+        *session_store* is a :class:`SessionStore` used to persist sessions
+        across processes.
         """
         self._username = username
         self._password = password
@@ -219,12 +943,26 @@ class RavelloClient(object):
         self._logger = logging.getLogger('ravello')
         self._autologin = True
         self._connection = None
+        self._adapter = None
+        self._pool_size = 0
+        self._generation = 0
+        self._login_lock = threading.RLock()
+        self._login_time = self._last_request = None
+        self._refresh_thread = None
+        self._refresh_stop = None
+        self.max_workers = self.default_max_workers
+        self._executor = None
+        self._executor_lock = threading.Lock()
         self._user_info = None
+        self._fingerprints = {}
+        self._fingerprints_lock = threading.Lock()
+        self._fingerprints_clock = 0
         self._set_url(url or self.default_url)
         self._proxies = {}
         if proxy_url is not None:
             self._proxies = {"http": proxy_url, "https": proxy_url}
         self._eph_token = eph_token
+        self.session_store = session_store
 
     @property
     def url(self):
@@ -263,11 +1001,17 @@ class RavelloClient(object):
         self.default_url = url
         self._url = urlsplit2(url)
 
-    def connect(self, url=None, proxy_url=None, eph_token=None):
+    def connect(self, url=None, proxy_url=None, eph_token=None, warm=None, login=False):
         """Connect to the API.
 
         It is not mandatory to call this method. If this method is not called,
         the client will automatically connect when required.
+
+        If *warm* is specified, up to *warm* connections to the API are opened
+        in parallel and kept in the connection pool, so that the first
+        requests do not pay for DNS lookups and TCP and TLS handshakes. If
+        *login* is true, the client also logs in now instead of on the first
+        request.
         """
         if url is not None:
             self._set_url(url)
@@ -277,6 +1021,37 @@ class RavelloClient(object):
             self._eph_token = eph_token
         if self._connection is not None:
             self._connection.proxies = self._proxies
+        if warm:
+            self._warm(warm)
+        if login and not self.logged_in:
+            self._relogin(self._generation)
+
+    def _ensure_pool_size(self, count):
+        if self._pool_size < count:
+            self._pool_size = max(count, requests.adapters.DEFAULT_POOLSIZE)
+            self._adapter = requests.adapters.HTTPAdapter(pool_maxsize=self._pool_size)
+            if self._connection is not None:
+                self._mount_adapter(self._connection)
+
+    def _warm(self, count):
+        self._ensure_pool_size(count)
+        connection = self._connection or self._new_connection()
+        with ThreadPoolExecutor(count) as executor:
+            list(executor.map(lambda i: self.probe(connection), range(count)))
+
+    def probe(self, connection=None):
+        """Probe the API endpoint.
+
+        An unauthenticated request is made to the API endpoint, and the round
+        trip time in seconds is returned. Any HTTP response means that the
+        endpoint is reachable. Network errors are raised as exceptions.
+        """
+        connection = connection or self._connection or self._new_connection()
+        start = time.time()
+        response = connection.get(self.default_url, timeout=self.timeout)
+        # Read the response so that the connection is returned to the pool.
+        response.content
+        return time.time() - start
 
     def login(self, username=None, password=None):
         """Login to the API.
@@ -298,21 +1073,137 @@ class RavelloClient(object):
     def _login(self):
         if not self.have_credentials and not self.have_eph_access_token:
             raise RuntimeError('no credentials or ephemeral access token set')
-        self._connection = requests.Session()
-        self._connection.proxies = self._proxies
-        self._connection.stream = True
-        self._connection.redirects = self.redirects
-        self._autologin = False
-        if self.have_credentials:
+        # A stored session is only used for the initial login. If it turns out
+        # to be invalid, the 401 causes a login with a live connection.
+        restore = self._connection is None and self.session_store is not None
+        # Log in on a new connection and only then switch to it, so that
+        # concurrent requests can keep using the current connection.
+        connection = self._new_connection()
+        if self.have_credentials and restore and self._restore_session(connection):
+            self._logger.debug('restored a stored session')
+        elif self.have_credentials:
             self._logger.debug('performing a username/password login')
             auth = '{0}:{1}'.format(self._username, self._password)
             auth = base64.b64encode(auth.encode('ascii')).decode('ascii')
             headers = [('Authorization', 'Basic {0}'.format(auth))]
-            response = self._request('POST', '/login', b'', headers)
-            self._user_info = response
+            response = self._request('POST', '/login', b'', headers, connection)
+            self._user_info = response.entity
+            self._save_session(connection)
         else:
             self._logger.debug('using ephemeral access based session')
-        self._autologin = True
+        self._connection = connection
+        self._generation += 1
+        self._login_time = self._last_request = time.time()
+
+    def _mount_adapter(self, connection):
+        connection.mount('https://', self._adapter)
+        connection.mount('http://', self._adapter)
+
+    def _new_connection(self):
+        connection = requests.Session()
+        connection.proxies = self._proxies
+        connection.stream = True
+        connection.redirects = self.redirects
+        # Share the connection pool between sessions, so that a new login
+        # does not need new connections.
+        if self._adapter is None:
+            self._pool_size = requests.adapters.DEFAULT_POOLSIZE
+            self._adapter = requests.adapters.HTTPAdapter(pool_maxsize=self._pool_size)
+        self._mount_adapter(connection)
+        return connection
+
+    def _relogin(self, generation):
+        # Log in again, unless another thread did so since *generation*. This
+        # makes concurrent requests that get a 401 share a single login.
+        with self._login_lock:
+            if self._generation == generation:
+                self._login()
+
+    def refresh_login(self):
+        """Log in again, replacing the current session.
+
+        Requests that are in progress complete on the current session.
+        """
+        self._relogin(self._generation)
+
+    def refresh_due(self, max_age, max_idle=None):
+        """Return whether the session is due for a refresh.
+
+        This is the case if the session is at least *max_age* seconds old, or
+        if no request was made on it for *max_idle* seconds.
+        """
+        if not self.logged_in:
+            return False
+        now = time.time()
+        if now - self._login_time >= max_age:
+            return True
+        return max_idle is not None and now - self._last_request >= max_idle
+
+    def start_refresh(self, max_age, max_idle=None):
+        """Refresh the session in a background thread before it expires.
+
+        The session is refreshed when :meth:`refresh_due` returns true for
+        *max_age* and *max_idle*, which should be set somewhat below the
+        session lifetime and idle timeout of the API. This way, requests do
+        not pay for a login when the session expires.
+        """
+        self.stop_refresh()
+        interval = min(t for t in (max_age, max_idle) if t is not None) / 4.0
+        self._refresh_stop = stop = threading.Event()
+
+        def refresh():
+            while True:
+                stop.wait(max(interval, 1))
+                if stop.is_set():
+                    break
+                if not self.refresh_due(max_age, max_idle):
+                    continue
+                try:
+                    self.refresh_login()
+                except Exception as e:
+                    self._logger.error('error refreshing session: {0!s}'.format(e))
+        self._refresh_thread = threading.Thread(target=refresh)
+        self._refresh_thread.daemon = True
+        self._refresh_thread.start()
+
+    def stop_refresh(self):
+        """Stop refreshing the session in the background."""
+        if self._refresh_stop is not None:
+            self._refresh_stop.set()
+        self._refresh_stop = self._refresh_thread = None
+
+    def _session_key(self):
+        return self.session_store.key(self.default_url, self._username)
+
+    def _restore_session(self, connection):
+        try:
+            session = self.session_store.load(self._session_key(), self._password)
+        except Exception as e:
+            self._logger.debug('could not load session: {0!s}'.format(e))
+            return False
+        if not session:
+            return False
+        now = time.time()
+        for cookie in session['cookies']:
+            if cookie.get('expires') and cookie['expires'] < now:
+                return False
+        for cookie in session['cookies']:
+            cookie = cookie.copy()
+            connection.cookies.set(cookie.pop('name'), cookie.pop('value'), **cookie)
+        self._user_info = session.get('user_info')
+        return True
+
+    def _save_session(self, connection):
+        if self.session_store is None:
+            return
+        cookies = [{'name': c.name, 'value': c.value, 'domain': c.domain, 'path': c.path,
+                    'secure': c.secure, 'expires': c.expires}
+                   for c in connection.cookies]
+        session = {'cookies': cookies, 'user_info': self._user_info}
+        try:
+            self.session_store.save(self._session_key(), session, self._password)
+        except Exception as e:
+            self._logger.debug('could not store session: {0!s}'.format(e))
 
     def logout(self):
         """Logout from the API.
@@ -321,6 +1212,8 @@ class RavelloClient(object):
         """
         if self.logged_in:
             self.request('POST', '/logout')
+            if self.session_store is not None and self.have_credentials:
+                self.session_store.delete(self._session_key())
         self._connection = None
 
     def close(self):
@@ -329,6 +1222,26 @@ class RavelloClient(object):
             return
         self._connection = None
 
+    @property
+    def executor(self):
+        """The thread pool that runs the ``*_async`` methods.
+
+        The pool is created on first use with :attr:`max_workers` threads.
+        The threads share the client and its session.
+        """
+        with self._executor_lock:
+            if self._executor is None:
+                self._ensure_pool_size(self.max_workers)
+                self._executor = ThreadPoolExecutor(self.max_workers)
+            return self._executor
+
+    def shutdown(self, wait=True):
+        """Shut down the thread pool of the client, if it was started."""
+        with self._executor_lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait)
+
     # The request() method is the main function. All other methods are a small
     # shim on top of this.
 
@@ -346,7 +1259,7 @@ class RavelloClient(object):
         response = self._request(method, path, body, headers)
         return response.entity
 
-    def _request(self, method, path, body=b'', headers=None):
+    def _request(self, method, path, body=b'', headers=None, connection=None):
         rpath = self._url.path + path
         abpath = self.default_url + path
         hdict = {'Accept': 'application/json'}
@@ -360,13 +1273,18 @@ class RavelloClient(object):
             for key, value in headers:
                 hdict[key] = value
         retries = 0
+        relogged_in = False
         while retries < self.retries:
-            if not self.logged_in and (self.have_credentials or self.have_eph_access_token) and self._autologin:
-                self._login()
+            autologin = self._autologin and (self.have_credentials or self.have_eph_access_token)
+            if connection is None and not self.logged_in and autologin:
+                self._relogin(self._generation)
+            generation = self._generation
+            conn = connection or self._connection
             try:
                 self._logger.debug('request: {0} {1}'.format(method, rpath))
-                req = requests.Request(method, abpath, data=body, headers=hdict, cookies=self._connection.cookies).prepare()
-                response = self._connection.send(req, timeout=self.timeout)
+                req = requests.Request(method, abpath, data=body, headers=hdict,
+                                       cookies=conn.cookies).prepare()
+                response = conn.send(req, timeout=self.timeout)
                 status = response.status_code
                 ctype = response.headers.get('Content-Type')
                 if ctype == 'application/json':
@@ -388,6 +1306,8 @@ class RavelloClient(object):
                         else:
                             href = abpath
                         entity['_href'] = href[len(self._url.path):]
+                        if response.headers.get('ETag'):
+                            entity['_etag'] = response.headers.get('ETag')
                     elif isinstance(entity, list):
                         for elem in entity:
                             if 'id' in elem:
@@ -405,20 +1325,26 @@ class RavelloClient(object):
                         rpath = url.path
                 elif status == 401:
                     if path == '/login':
-                        self.close()
+                        if connection is None:
+                            self.close()
                         response.raise_for_status()
-                    elif self._autologin:
-                        self._login()
-                        retries += 1
+                    elif self._autologin and not relogged_in and connection is None:
+                        # The session expired or was invalidated. This does
+                        # not count as a retry, but is only done once.
+                        self._relogin(generation)
+                        relogged_in = True
                         continue
+                    response.raise_for_status()
                 elif status == 404:
                     entity = None
                 else:
                     response.raise_for_status()
                 response.entity = entity
+                self._last_request = time.time()
             except (requests.exceptions.Timeout, ValueError) as e:
                 self._logger.debug('error: {0!s}'.format(e))
-                self.close()
+                if connection is None:
+                    self.close()
                 if not _idempotent(method):
                     self._logger.debug('not retrying {0} request'.format(method))
                     raise e
@@ -438,7 +1364,57 @@ class RavelloClient(object):
         href = obj.get('_href')
         if href is None:
             raise RuntimeError('obj must have an "_href" key')
-        return self.request('GET', href)
+        obj = self.request('GET', href)
+        if href.startswith('/applications/'):
+            self._track_application(obj)
+        return obj
+
+    def _track_application(self, app):
+        # Remember the fingerprint of an application as it is known on the
+        # server. This is used by update_application() to skip or narrow down
+        # updates.
+        if isinstance(app, dict) and 'id' in app and 'design' in app:
+            fp = fingerprint_application(app)
+            with self._fingerprints_lock:
+                self._fingerprints_clock += 1
+                self._fingerprints[app['id']] = (fp, self._fingerprints_clock)
+                if len(self._fingerprints) > self.max_fingerprints:
+                    # Forget the least recently used half. This keeps eviction
+                    # amortized constant time.
+                    keys = sorted(self._fingerprints, key=lambda k: self._fingerprints[k][1])
+                    for key in keys[:len(keys) - self.max_fingerprints // 2]:
+                        del self._fingerprints[key]
+        return app
+
+    def _fingerprint(self, appid):
+        # Return the remembered fingerprint for an application, or None.
+        with self._fingerprints_lock:
+            entry = self._fingerprints.get(appid)
+            if entry is None:
+                return
+            self._fingerprints_clock += 1
+            self._fingerprints[appid] = (entry[0], self._fingerprints_clock)
+            return entry[0]
+
+    def _changed_vm(self, app, old, new):
+        # Return the single design VM in *app* that changed between
+        # fingerprints *old* and *new*, or None if anything else changed.
+        changed = new.changed_vms(old)
+        if len(changed) != 1:
+            return
+        vmid = changed.pop()
+        if vmid not in old.vms or vmid not in new.vms:
+            return
+        known = {}
+        target = None
+        for vm in app['design']['vms']:
+            known[id(vm)] = binascii.unhexlify(new.vms[vm.get('id')])
+            if vm.get('id') == vmid:
+                known[id(vm)] = binascii.unhexlify(old.vms[vmid])
+                target = vm
+        ignore = fingerprint_ignore | frozenset(['deployment'])
+        if _hexdigest(_digest(app, ignore, known)) == old.digest:
+            return target
 
     def wait_for(self, obj, cond, timeout=None):
         """Wait for a condition on *obj* to become true.
@@ -467,6 +1443,101 @@ class RavelloClient(object):
         if end_time < time.time():
             raise RavelloError('timeout waiting for condition')
 
+    def _update(self, path, obj):
+        # Update *obj*, conditional on its entity tag if known.
+        headers = []
+        if obj.get('_etag'):
+            headers.append(('If-Match', obj['_etag']))
+        try:
+            return self.request('PUT', path, obj, headers)
+        except requests.exceptions.HTTPError as e:
+            if not _is_conflict(e):
+                raise
+            raise RavelloConflictError('{0} was modified concurrently'.format(path))
+
+    def _modify(self, kind, get, update, obj, func, retries=None):
+        # Get *obj*, apply *func*, and update it. Retry on conflicts.
+        if isinstance(obj, dict): obj = obj['id']
+        retries = retries if retries is not None else self.retries
+        attempt = 0
+        while True:
+            current = get(obj)
+            if current is None:
+                raise RavelloError('no such {0}: {1}'.format(kind, obj))
+            result = func(current)
+            if result is not None:
+                current = result
+            try:
+                return update(current)
+            except RavelloConflictError:
+                attempt += 1
+                if attempt >= retries:
+                    raise
+                self._logger.debug('conflict updating {0} {1}, retrying'.format(kind, obj))
+
+    def edit_session(self, window=None, retries=None):
+        """Return a new :class:`EditSession` for this client.
+
+        See :class:`EditSession` for the meaning of *window* and *retries*.
+        """
+        return EditSession(self, window, retries)
+
+    def set_vm_states(self, app, targets, max_concurrency=None):
+        """Bring the VMs in the application *app* to their target states.
+
+        The current state is loaded with a single request, and the calls are
+        planned with :func:`plan_vm_states` and made concurrently. The plan is
+        returned. See :func:`plan_vm_states` for the meaning of *targets*.
+        """
+        app = self.get_application(app, 'deployment')
+        if app is None:
+            raise RavelloError('application does not exist')
+        plan = plan_vm_states(app, targets)
+        plan.run(self, max_concurrency)
+        return plan
+
+    def get_fleet_snapshot(self, apps=None, max_concurrency=None):
+        """Return a :class:`FleetSnapshot` of the deployed VMs.
+
+        The deployment of each application in *apps* (defaulting to all
+        published applications) is loaded concurrently, one request per
+        application. Applications that no longer exist are left out.
+        """
+        return FleetSnapshot(self._get_deployments(apps, max_concurrency))
+
+    def get_fleet_table(self, apps=None, charges=True, max_concurrency=None):
+        """Return a :class:`FleetTable` of the deployed VMs.
+
+        The deployments are loaded as for :meth:`get_fleet_snapshot`. If
+        *charges* is true, the charges since the beginning of the month are
+        loaded with :meth:`get_billing`.
+        """
+        billing = self.get_billing() if charges else None
+        return FleetTable(self._get_deployments(apps, max_concurrency), billing)
+
+    def _get_deployments(self, apps, max_concurrency):
+        if apps is None:
+            apps = [app for app in self.get_applications() if app.get('published')]
+        batch = self.batch(max_concurrency)
+        for app in apps:
+            batch.get_application(app, 'deployment')
+        deployed = []
+        for app, result in zip(apps, batch.run()):
+            if result is None:
+                continue
+            if isinstance(app, dict) and 'name' in app:
+                result.setdefault('name', app['name'])
+            deployed.append(result)
+        return deployed
+
+    def batch(self, max_concurrency=None, fail_fast=False):
+        """Return a new :class:`Batch` for this client.
+
+        See :class:`Batch` for the meaning of *max_concurrency* and
+        *fail_fast*.
+        """
+        return Batch(self, max_concurrency, fail_fast)
+
     # Mapped API calls below
 
     def get_application_by_name(self, app_name, aspect=None):
@@ -502,7 +1573,7 @@ class RavelloClient(object):
         if isinstance(app, dict): app = app['id']
         if aspect is not None:
             app = '{0};{1}'.format(app, aspect)
-        return self.request('GET', '/applications/{0}'.format(app))
+        return self._track_application(self.request('GET', '/applications/{0}'.format(app)))
 
     def get_applications(self, filter=None):
         """Return a list with all applications.
@@ -523,23 +1594,73 @@ class RavelloClient(object):
 
         The new application is returned.
         """
-        return self.request('POST', '/applications', app)
+        return self._track_application(self.request('POST', '/applications', app))
 
-    def update_application(self, app):
+    def update_application(self, app, only_changed=True):
         """Update an existing application.
 
         The *app* parameter must be the updated application. The way to update
         an application (or any other resource) is to first retrieve it, make
         the updates client-side, and then use this method to make the update.
 
+        The client remembers the fingerprints of the :attr:`max_fingerprints`
+        applications it retrieved most recently. If *only_changed* is true (the
+        default) and *app* was retrieved by this client, then no request is made
+        at all if *app* is unchanged, and only the VM is updated (see
+        :meth:`update_vm`) if a single existing VM in the design changed and
+        *app* has no entity tag.
+
+        If *app* carries an ``"_etag"`` key, which is set when the server returns
+        an entity tag, the update is made conditional on the application not
+        having been modified since. A :class:`RavelloConflictError` is raised
+        if the application was modified concurrently. See
+        :meth:`modify_application` for a way to handle this.
+
         The updated application is returned.
         """
-        return self.request('PUT', '/applications/{0}'.format(app['id']), app)
+        old = self._fingerprint(app['id']) if only_changed else None
+        if old is not None:
+            new = fingerprint_application(app)
+            if new.digest == old.digest:
+                self._logger.debug('application {0} unchanged, not updating'.format(app['id']))
+                return app
+            # A VM update is not conditional, and it would leave *app* with a
+            # stale entity tag. So only narrow down the update if there is none.
+            vm = self._changed_vm(app, old, new) if not app.get('_etag') else None
+            if vm is not None:
+                updated = self.update_vm(app, vm)
+                if not isinstance(updated, dict):
+                    updated = vm
+                app = app.copy()
+                app['design'] = app['design'].copy()
+                app['design']['vms'] = [updated if elem is vm else elem
+                                        for elem in app['design']['vms']]
+                return self._track_application(app)
+        updated = self._update('/applications/{0}'.format(app['id']), app)
+        return self._track_application(updated)
+
+    def modify_application(self, app, func, retries=None):
+        """Modify the application with ID *app* with edit function *func*.
+
+        The application is retrieved, and *func* is called with it as its
+        argument. The function should modify the application in place, or
+        return the modified application. The result is then updated using
+        :meth:`update_application`. If the application was modified
+        concurrently, the application is retrieved again and *func* is
+        re-applied. At most *retries* attempts are made, defaulting to the
+        client's retries, after which :class:`RavelloConflictError` is raised.
+
+        The updated application is returned.
+        """
+        return self._modify('application', self.get_application,
+                            self.update_application, app, func, retries)
 
     def delete_application(self, app):
         """Delete an application with ID *app*."""
         if isinstance(app, dict): app = app['id']
         self.request('DELETE', '/applications/{0}'.format(app))
+        with self._fingerprints_lock:
+            self._fingerprints.pop(app, None)
 
     def publish_application(self, app, req={"optimizationLevel":"COST_OPTIMIZED"}):
         """Publish the application with ID *app*.
@@ -619,6 +1740,14 @@ class RavelloClient(object):
             app = '{0};{1}'.format(app, aspect)
         return self.request('GET', '/applications/{0}/vms/{1}'.format(app, vm))
 
+    def update_vm(self, app, vm):
+        """Update the VM *vm* in the design of the application with ID *app*.
+
+        The *vm* parameter must be the updated VM. The updated VM is returned.
+        """
+        if isinstance(app, dict): app = app['id']
+        return self.request('PUT', '/applications/{0}/vms/{1}'.format(app, vm['id']), vm)
+
     def get_vms(self, app, filter=None, level='design'):
         """Return a list with all vms (for a given app).
 
@@ -736,6 +1865,70 @@ class RavelloClient(object):
         if isinstance(app, dict): app = app['id']
         return self.request('POST', '/applications/{0}/vms'.format(app), {'baseVmId':library_vm_id})
 
+    def add_library_vms(self, app, specs, publish=False):
+        """Add VMs from the library to the design of the application *app*.
+
+        The *specs* parameter is a list of ``(library_vm_id, count, overrides)``
+        tuples, where *overrides* is a dict with VM attributes to set on the
+        new VMs, or None. Each library VM is loaded once. The new VMs get new
+        LUIDs, and unique names based on the name of the library VM (or the
+        "name" override). All VMs are added with a single conditional update,
+        see :meth:`modify_application`. If *publish* is true, the updates are
+        published as well. Returns the updated application.
+        """
+        templates = []
+        loaded = {}
+        for libvm, count, overrides in specs:
+            if isinstance(libvm, dict): libvm = libvm['id']
+            if libvm not in loaded:
+                image = self.get_image(libvm)
+                if image is None:
+                    raise RavelloError('library vm does not exist: {0}'.format(libvm))
+                loaded[libvm] = dict((key, value) for key, value in image.items()
+                                     if key not in _library_only)
+            template = dict(loaded[libvm], baseVmId=libvm)
+            template.update(overrides or {})
+            templates.append((template, count))
+
+        def add(app):
+            design = app.setdefault('design', {})
+            vms = design.setdefault('vms', [])
+            for template, count in templates:
+                prefix = '{0}-'.format(template['name'])
+                names = NameAllocator(vms, prefix).allocate(count)
+                for vm, name in zip(clone_with_new_luids(template, count, design), names):
+                    vm['name'] = name
+                    suffix = name[len(prefix):]
+                    if vm.get('hostnames'):
+                        vm['hostnames'] = ['{0}-{1}'.format(hostname, suffix)
+                                           for hostname in vm['hostnames']]
+                    vms.append(vm)
+        app = self.modify_application(app, add)
+        if publish:
+            self.publish_application_updates(app)
+        return app
+
+    def remove_vms(self, app, vms, publish=False):
+        """Remove the VMs with IDs *vms* from the design of the application *app*.
+
+        All VMs are removed with a single conditional update, see
+        :meth:`modify_application`. If *publish* is true, the updates are
+        published as well. Returns the updated application.
+        """
+        remove = set(vm['id'] if isinstance(vm, dict) else int(vm) for vm in vms)
+
+        def delete(app):
+            design_vms = app.get('design', {}).get('vms', [])
+            missing = remove - set(vm['id'] for vm in design_vms if 'id' in vm)
+            if missing:
+                raise RavelloError('vms not in design: {0}'.format(
+                                   ', '.join(str(vmid) for vmid in sorted(missing))))
+            app['design']['vms'] = [vm for vm in design_vms if vm.get('id') not in remove]
+        app = self.modify_application(app, delete)
+        if publish:
+            self.publish_application_updates(app)
+        return app
+
     def delete_vm_from_application(self, app, vm):
         """Deletes a single VM from an existing application's design (note that you will still need to publish the update)
         *app* the application (object or ID) to delete the library VM from
@@ -807,9 +2000,17 @@ class RavelloClient(object):
         """Update an existing image.
 
         The *img* parameter must be the updated image.  The updated image is
-        returned.
+        returned. Concurrent modifications are detected in the same way as for
+        :meth:`update_application`.
         """
-        return self.request('PUT', '/images/{0}'.format(img['id']), img)
+        return self._update('/images/{0}'.format(img['id']), img)
+
+    def modify_image(self, img, func, retries=None):
+        """Modify the image with ID *img* with edit function *func*.
+
+        See :meth:`modify_application` for details.
+        """
+        return self._modify('image', self.get_image, self.update_image, img, func, retries)
 
     def delete_image(self, img):
         """Delete the image with ID *img*."""
@@ -1208,3 +2409,821 @@ class RavelloClient(object):
         """Retrieves all communities."""
         return self.request('GET', '/communities')
 
+
+# Methods that do not get an ``*_async`` variant.
+_sync_only = frozenset(['connect', 'login', 'logout', 'close', 'shutdown', 'edit_session',
+                        'batch', 'start_refresh', 'stop_refresh', 'refresh_due'])
+
+
+def _make_async(name):
+    def method(self, *args, **kwargs):
+        return self.executor.submit(getattr(self, name), *args, **kwargs)
+    method.__name__ = '{0}_async'.format(name)
+    method.__doc__ = 'Like :meth:`{0}`, but run it on :attr:`executor` and ' \
+                     'return a :class:`concurrent.futures.Future`.'.format(name)
+    return method
+
+
+# Add a Future returning variant for every API method of the client.
+for _name, _func in sorted(vars(RavelloClient).items()):
+    if _name.startswith('_') or _name in _sync_only or not inspect.isfunction(_func):
+        continue
+    setattr(RavelloClient, '{0}_async'.format(_name), _make_async(_name))
+del _name, _func
+
+
+def _wait(fs, timeout):
+    done, not_done = futures.wait(fs, timeout)
+    if not_done:
+        raise RavelloError('{0} of {1} calls did not complete within {2} seconds'
+                           .format(len(not_done), len(fs), timeout))
+
+
+def gather(fs, return_exceptions=False, timeout=None):
+    """Wait for the futures in *fs* and return their results, in order.
+
+    If a call raised an exception, the first such exception (in the order of
+    *fs*) is raised, unchanged. If *return_exceptions* is true, exceptions are
+    returned in place of the result instead. If not all calls complete within
+    *timeout* seconds, a :class:`RavelloError` is raised.
+    """
+    fs = list(fs)
+    _wait(fs, timeout)
+    if return_exceptions:
+        return [f.exception() or f.result() for f in fs]
+    return [f.result() for f in fs]
+
+
+def as_completed(fs, timeout=None):
+    """Yield the futures in *fs* as they complete.
+
+    This is like :func:`concurrent.futures.as_completed`, but raises a
+    :class:`RavelloError` if not all calls complete within *timeout* seconds.
+    """
+    fs = list(fs)
+    try:
+        for f in futures.as_completed(fs, timeout):
+            yield f
+    except futures.TimeoutError:
+        raise RavelloError('not all of {0} calls completed within {1} seconds'
+                           .format(len(fs), timeout))
+
+
+class EditSession(object):
+    """Collect edits to applications and images, and write them back with a
+    single update per object.
+
+    An edit is a callable that is passed the object to update. It should
+    modify it in place, or return the modified object. Edits are queued with
+    :meth:`edit_application` and :meth:`edit_image`, and are written by
+    :meth:`flush`. Flushing loads every object once, applies all its edits in
+    the order in which they were queued, and updates it with a single call.
+    If the update fails because the object was modified concurrently, the
+    object is loaded again and the edits are re-applied, up to *retries* times
+    (defaulting to the client's retries).
+
+    The session can be used as a context manager, in which case it is flushed
+    when the block exits without an exception. If *window* is specified, the
+    session is also flushed from a background thread *window* seconds after the
+    first edit is queued.
+    """
+
+    def __init__(self, client, window=None, retries=None):
+        self._client = client
+        self.window = window
+        self.retries = retries if retries is not None else client.retries
+        self._keys = []
+        self._edits = {}
+        self._lock = threading.RLock()
+        self._timer = None
+
+    @property
+    def pending(self):
+        """The number of objects with pending edits."""
+        return len(self._keys)
+
+    def _add(self, kind, obj, func):
+        if isinstance(obj, dict): obj = obj['id']
+        key = (kind, obj)
+        with self._lock:
+            if key not in self._edits:
+                self._keys.append(key)
+                self._edits[key] = []
+            self._edits[key].append(func)
+            if self.window is not None and self._timer is None:
+                self._timer = threading.Timer(self.window, self._flush_timer)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def edit_application(self, app, func):
+        """Queue edit *func* for the application with ID *app*."""
+        self._add('application', app, func)
+
+    def edit_image(self, img, func):
+        """Queue edit *func* for the image with ID *img*."""
+        self._add('image', img, func)
+
+    def _apply(self, kind, objid, funcs):
+        def edit(obj):
+            for func in funcs:
+                result = func(obj)
+                if result is not None:
+                    obj = result
+            return obj
+        if kind == 'application':
+            return self._client.modify_application(objid, edit, self.retries)
+        else:
+            return self._client.modify_image(objid, edit, self.retries)
+
+    def flush(self):
+        """Write all pending edits.
+
+        Objects are written in the order in which their first edit was queued.
+        If writing an object fails, the exception is raised and the edits for
+        the object and all objects after it remain pending.
+        """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            while self._keys:
+                kind, objid = key = self._keys[0]
+                self._apply(kind, objid, self._edits[key])
+                del self._keys[0]
+                del self._edits[key]
+
+    def _flush_timer(self):
+        with self._lock:
+            self._timer = None
+            try:
+                self.flush()
+            except Exception as e:
+                self._client._logger.error('error flushing edits: {0!s}'.format(e))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if exc_info[0] is None:
+            self.flush()
+
+
+class _PoolEntry(object):
+    """A client in a :class:`ClientPool`."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.client = None
+        self.login_time = self.last_used = time.time()
+
+
+class ClientPool(object):
+    """A pool of logged-in clients, keyed by credentials.
+
+    Services that act on behalf of many users can use a pool instead of
+    logging in for every operation. :meth:`get` returns a logged-in client for
+    a username and password, or for an ephemeral access token, and creates it
+    if needed. Clients are shared between callers and threads.
+
+    At most *maxsize* clients are kept. When the pool is full, the least
+    recently used client is evicted. If *max_idle* is specified, clients that
+    have not been used for that many seconds are evicted as well. If *refresh*
+    is specified, clients are logged in again once their login is *refresh*
+    seconds old, so that callers do not pay for a login when their session
+    expires. Eviction of idle clients and refreshes are done by a background
+    thread. Evicted clients are not closed, and remain usable by callers that
+    still hold them.
+
+    Other keyword arguments are passed to :class:`RavelloClient`.
+    """
+
+    client_class = RavelloClient
+
+    def __init__(self, maxsize=100, max_idle=None, refresh=None, **kwargs):
+        self.maxsize = maxsize
+        self.max_idle = max_idle
+        self.refresh = refresh
+        self._kwargs = kwargs
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._thread = None
+        if max_idle is not None or refresh is not None:
+            self._thread = threading.Thread(target=self._maintain_thread)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def _key(username, password, eph_token):
+        # Do not keep the credentials around as dictionary keys.
+        ident = '\0'.join([username or '', password or '', eph_token or ''])
+        return hashlib.sha256(ident.encode('utf8')).hexdigest()
+
+    def _evict_lru(self, keep):
+        while len(self._entries) > self.maxsize:
+            victim = min((entry.last_used, key) for key, entry in self._entries.items()
+                         if key != keep)[1]
+            del self._entries[victim]
+
+    def get(self, username=None, password=None, eph_token=None):
+        """Return a logged-in client for *username* and *password*, or for
+        the ephemeral access token *eph_token*."""
+        if eph_token is None and (username is None or password is None):
+            raise RuntimeError('no credentials or ephemeral access token set')
+        key = self._key(username, password, eph_token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = _PoolEntry()
+                self._evict_lru(key)
+        entry.last_used = time.time()
+        if entry.client is not None:
+            return entry.client
+        # Only one thread logs in for a given set of credentials.
+        with entry.lock:
+            if entry.client is None:
+                client = self.client_class(username, password, eph_token=eph_token, **self._kwargs)
+                try:
+                    client.login()
+                except Exception:
+                    with self._lock:
+                        if self._entries.get(key) is entry:
+                            del self._entries[key]
+                    raise
+                entry.login_time = time.time()
+                entry.client = client
+        return entry.client
+
+    def maintain(self):
+        """Evict idle clients and refresh old logins.
+
+        This is called periodically by the background thread, if the pool has
+        one.
+        """
+        now = time.time()
+        with self._lock:
+            entries = list(self._entries.items())
+        for key, entry in entries:
+            if self.max_idle is not None and now - entry.last_used > self.max_idle:
+                with self._lock:
+                    if self._entries.get(key) is entry:
+                        del self._entries[key]
+                continue
+            if self.refresh is None or entry.client is None \
+                        or now - entry.login_time < self.refresh:
+                continue
+            with entry.lock:
+                try:
+                    entry.client.refresh_login()
+                except Exception as e:
+                    entry.client._logger.error('error refreshing login: {0!s}'.format(e))
+                else:
+                    entry.login_time = time.time()
+
+    def _maintain_thread(self):
+        interval = min(t for t in (self.max_idle, self.refresh) if t is not None) / 2.0
+        while True:
+            self._closed.wait(max(interval, 1))
+            if self._closed.is_set():
+                break
+            self.maintain()
+
+    def close(self):
+        """Stop the background thread and close all clients."""
+        self._closed.set()
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+        for entry in entries:
+            if entry.client is not None:
+                entry.client.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class BatchCall(object):
+    """A call queued in a :class:`Batch`.
+
+    After the batch has run, either *result* or *exception* is set, unless
+    the call was *skipped* because an earlier call failed in fail-fast mode.
+    """
+
+    def __init__(self, method, args, kwargs):
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.result = None
+        self.exception = None
+        self.skipped = False
+
+    def __str__(self):
+        args = [repr(arg.get('id', arg) if isinstance(arg, dict) else arg) for arg in self.args]
+        args += ['{0}={1!r}'.format(key, value) for key, value in sorted(self.kwargs.items())]
+        return '{0}({1})'.format(self.method, ', '.join(args))
+
+
+class Batch(object):
+    """Queue API calls and run them concurrently.
+
+    Any API method of the client can be called on the batch. Instead of
+    making the call, a :class:`BatchCall` is queued and returned. The calls
+    are made by :meth:`run`, with at most *max_concurrency* calls in flight
+    (defaulting to the client's :attr:`RavelloClient.max_workers`). The calls
+    go through the client, and use its session and retry settings.
+
+    All calls are made, even if some fail, unless *fail_fast* is true. In that
+    case, calls that were not started when the first call failed are skipped.
+    If any call failed, a :class:`BatchError` that reports all failures is
+    raised.
+
+    The batch can be used as a context manager, in which case it is run when
+    the block exits without an exception.
+    """
+
+    def __init__(self, client, max_concurrency=None, fail_fast=False):
+        self._client = client
+        self.max_concurrency = max_concurrency or client.max_workers
+        self.fail_fast = fail_fast
+        self.calls = []
+
+    def __getattr__(self, name):
+        batchable = not (name.startswith('_') or name in _sync_only or name.endswith('_async'))
+        if not batchable or not inspect.isfunction(getattr(RavelloClient, name, None)):
+            raise AttributeError(name)
+
+        def queue(*args, **kwargs):
+            call = BatchCall(name, args, kwargs)
+            self.calls.append(call)
+            return call
+        return queue
+
+    def run(self):
+        """Make all queued calls.
+
+        Return the list of results, in the order in which the calls were
+        queued. If any call failed, raise :class:`BatchError`.
+        """
+        calls, self.calls = self.calls, []
+        failed = threading.Event()
+
+        def run1(call):
+            if failed.is_set():
+                call.skipped = True
+                return
+            try:
+                call.result = getattr(self._client, call.method)(*call.args, **call.kwargs)
+            except Exception as e:
+                call.exception = e
+                if self.fail_fast:
+                    failed.set()
+        if calls:
+            workers = min(self.max_concurrency, len(calls))
+            # Keep a pooled connection for every worker.
+            self._client._ensure_pool_size(workers)
+            with ThreadPoolExecutor(workers) as executor:
+                list(executor.map(run1, calls))
+        if any(call.exception is not None for call in calls):
+            raise BatchError(calls)
+        return [call.result for call in calls]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if exc_info[0] is None:
+            self.run()
+
+
+class ApplicationPool(object):
+    """A pool of applications that are published from blueprints ahead of
+    time, and that can be handed out immediately.
+
+    The *sizes* parameter is a dict mapping blueprint IDs to the number of
+    ready applications to keep for that blueprint. Applications are created
+    with :meth:`~RavelloClient.create_application`, published with the
+    parameters in *publish*, and are ready once all their VMs are in *state*,
+    which is "STARTED" or "STOPPED". If *expiration* is specified, it is set
+    as the expiration in seconds when an application becomes ready.
+
+    Applications are provisioned in the background by :meth:`replenish`,
+    with at most *max_concurrency* applications in progress. Provisioning an
+    application may take up to *timeout* seconds. Pool applications are
+    named "<prefix><blueprint>-<number>", and their description is
+    :attr:`description`. :meth:`adopt` adds existing pool applications, so
+    that a restarted process can reuse them.
+
+    :meth:`acquire` hands out an application, and optionally renames it. Its
+    description is changed to :attr:`acquired`, so that it is not adopted
+    again. The API has no call to change the owner of an application, so
+    reassignment is left to the *assign* callable, which is called with the
+    client, the application and the *owner* passed to :meth:`acquire`.
+    """
+
+    description = 'Application pool'
+    acquired = 'Acquired from application pool'
+
+    def __init__(self, client, sizes, publish=None, state='STARTED', expiration=None,
+                 prefix='pool-', max_concurrency=4, timeout=1800, assign=None):
+        if state not in ('STARTED', 'STOPPED'):
+            raise ValueError('unsupported state: {0}'.format(state))
+        self._client = client
+        self.sizes = dict(sizes)
+        self.publish = dict(publish or {'optimizationLevel': 'COST_OPTIMIZED'})
+        self.publish['startAllVms'] = state == 'STARTED'
+        self.state = state
+        self.expiration = expiration
+        self.prefix = prefix
+        self.timeout = timeout
+        self.assign = assign
+        self._ready = dict((bp, []) for bp in self.sizes)
+        self._pending = dict((bp, 0) for bp in self.sizes)
+        self._names = None
+        self._cond = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_concurrency)
+
+    def _check_blueprint(self, bp):
+        if bp not in self.sizes:
+            raise RavelloError('blueprint not managed by pool: {0}'.format(bp))
+
+    def ready(self, bp):
+        """Return the number of ready applications for blueprint *bp*."""
+        self._check_blueprint(bp)
+        with self._cond:
+            return len(self._ready[bp])
+
+    def _prefix(self, bp):
+        return '{0}{1}-'.format(self.prefix, bp)
+
+    def adopt(self, apps=None):
+        """Add existing published pool applications to the pool.
+
+        The applications are taken from *apps*, or from a listing of all
+        applications. Only applications named like pool applications for one
+        of the blueprints in the pool, and that were not handed out by
+        :meth:`acquire`, are adopted.
+        """
+        if apps is None:
+            apps = self._client.get_applications()
+        with self._cond:
+            self._names = list(apps)
+            known = set(app['id'] for ready in self._ready.values() for app in ready)
+            for app in apps:
+                if not app.get('published') or app['id'] in known:
+                    continue
+                if app.get('description') != self.description:
+                    continue
+                for bp in self._ready:
+                    if app['name'].startswith(self._prefix(bp)):
+                        self._ready[bp].append(app)
+            self._cond.notify_all()
+
+    def replenish(self, bp=None):
+        """Start provisioning applications for blueprint *bp* (or all
+        blueprints) until the pool has its configured size again."""
+        if bp is not None:
+            self._check_blueprint(bp)
+        blueprints = [bp] if bp is not None else list(self.sizes)
+        if self._names is None:
+            names = self._client.get_applications()
+        with self._cond:
+            if self._names is None:
+                self._names = names
+            for bp in blueprints:
+                count = self.sizes[bp] - len(self._ready[bp]) - self._pending[bp]
+                if count <= 0:
+                    continue
+                names = NameAllocator(self._names, self._prefix(bp)).allocate(count)
+                self._names.extend({'name': name} for name in names)
+                self._pending[bp] += count
+                for name in names:
+                    self._executor.submit(self._provision, bp, name)
+
+    def _provision(self, bp, name):
+        client = self._client
+        app = None
+        try:
+            app = client.create_application({'name': name, 'baseBlueprintId': bp,
+                                             'description': self.description})
+            client.publish_application(app, self.publish)
+            client.wait_for(app, lambda app: application_state(app) == self.state,
+                            self.timeout)
+            if self.expiration is not None:
+                req = {'expirationFromNowSeconds': self.expiration}
+                client.set_application_expiration(app, req)
+        except Exception as e:
+            client._logger.error('error provisioning {0}: {1!s}'.format(name, e))
+            if app is not None:
+                try:
+                    client.delete_application(app)
+                except Exception:
+                    pass
+            with self._cond:
+                self._pending[bp] -= 1
+                self._cond.notify_all()
+            return
+        with self._cond:
+            self._pending[bp] -= 1
+            self._ready[bp].append(app)
+            self._cond.notify_all()
+
+    def _take(self, bp, end_time):
+        # Remove a ready application for *bp* from the pool, waiting until
+        # *end_time* if needed.
+        retried = False
+        while True:
+            with self._cond:
+                while not self._ready[bp] and self._pending[bp]:
+                    remaining = end_time - time.time() if end_time is not None else None
+                    if remaining is not None and remaining <= 0:
+                        raise RavelloError('no application ready for blueprint {0}'.format(bp))
+                    self._cond.wait(remaining)
+                if self._ready[bp]:
+                    return self._ready[bp].pop(0)
+                if self.sizes[bp] == 0:
+                    raise RavelloError('pool for blueprint {0} is empty'.format(bp))
+                if retried:
+                    raise RavelloError('could not provision an application for '
+                                       'blueprint {0}'.format(bp))
+            # Nothing is ready or in progress, e.g. because provisioning
+            # failed. Try once more.
+            self.replenish(bp)
+            retried = True
+
+    def acquire(self, bp, name=None, owner=None, expiration=None, timeout=None):
+        """Hand out a ready application for blueprint *bp*.
+
+        If no application is ready, wait for up to *timeout* seconds (or
+        indefinitely) for one, and raise a :class:`RavelloError` if none
+        becomes ready. The application is removed from the pool and marked as
+        acquired, and a replacement is provisioned in the background. If
+        *name* is provided, the application is renamed. If *owner* is
+        provided, the *assign* callable of the pool is called. If *expiration*
+        is provided, it is set as the expiration in seconds. Returns the
+        application.
+
+        Applications that were deleted, or that are no longer in the state
+        of the pool (e.g. because they expired), are discarded and the next
+        one is taken.
+        """
+        self._check_blueprint(bp)
+        end_time = time.time() + timeout if timeout is not None else None
+        client = self._client
+        while True:
+            app = self._take(bp, end_time)
+            self.replenish(bp)
+            current = client.get_application(app)
+            if current is not None and application_state(current) == self.state:
+                app = current
+                break
+            client._logger.debug('discarding stale pool application {0}'.format(app['name']))
+            if current is not None:
+                try:
+                    client.delete_application(current)
+                except Exception as e:
+                    client._logger.error('error deleting {0}: {1!s}'.format(app['name'], e))
+        app['description'] = self.acquired
+        if name is not None:
+            app['name'] = name
+        app = client.update_application(app)
+        if owner is not None:
+            if self.assign is None:
+                raise RavelloError('pool has no assign callable')
+            self.assign(client, app, owner)
+        if expiration is not None:
+            client.set_application_expiration(app, {'expirationFromNowSeconds': expiration})
+        return app
+
+    def close(self, wait=False):
+        """Stop provisioning. Ready applications are left as they are."""
+        self._executor.shutdown(wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _elastic_ip_address(eip):
+    return eip['ip'] if isinstance(eip, dict) else eip
+
+
+class ElasticIpPool(object):
+    """A pool of pre-allocated elastic IPs per location.
+
+    The *watermarks* parameter is a dict mapping locations to ``(low, high)``
+    tuples, or a single ``(low, high)`` tuple that applies to all locations
+    returned by :meth:`~RavelloClient.get_elastic_ip_locations`. When the
+    number of free IPs in a location drops below *low*, new IPs are created
+    in the background until there are *high* free IPs again. Free IPs that
+    the pool created itself are deleted when there are more than *high*.
+
+    Call :meth:`reconcile` on start-up to add the free elastic IPs that
+    already exist in the account to the pool. An elastic IP is considered
+    free if no VM in an application design refers to it. These IPs were not
+    created by the pool, and they are only deleted by an explicit
+    ``release(adopted=True)``.
+    """
+
+    def __init__(self, client, watermarks, max_concurrency=4):
+        self._client = client
+        self._watermarks = watermarks
+        self.watermarks = dict(watermarks) if isinstance(watermarks, dict) else None
+        self._free = {}
+        self._pending = {}
+        self._owned = set()
+        self._cond = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_concurrency)
+
+    def _locations(self, location=None):
+        if self.watermarks is None:
+            locations = self._client.get_elastic_ip_locations()
+            locations = [loc['name'] if isinstance(loc, dict) else loc for loc in locations]
+            with self._cond:
+                if self.watermarks is None:
+                    self.watermarks = dict((loc, self._watermarks) for loc in locations)
+        if location is None:
+            return list(self.watermarks)
+        if location not in self.watermarks:
+            raise RavelloError('location not managed by pool: {0}'.format(location))
+        return [location]
+
+    def available(self, location):
+        """Return the number of free IPs in *location*."""
+        with self._cond:
+            return len(self._free.get(location, []))
+
+    def _used(self, apps):
+        # Return the elastic IPs that the VMs in the designs of *apps* refer to.
+        client = self._client
+        if apps is None:
+            apps = client.get_applications()
+
+        def load(app):
+            if isinstance(app, dict) and 'design' in app:
+                return app
+            return client.get_application(app, 'design')
+
+        used = set()
+        for app in self._executor.map(load, apps):
+            if app is None:
+                continue
+            for vm in app.get('design', {}).get('vms', []):
+                for conn in vm.get('networkConnections', []):
+                    ip = conn.get('ipConfig', {}).get('elasticIpAddress')
+                    if ip:
+                        used.add(ip)
+        return used
+
+    def reconcile(self, eips=None, apps=None):
+        """Synchronize the pool with the elastic IPs in the account.
+
+        The IPs are taken from *eips*, or from
+        :meth:`~RavelloClient.get_elastic_ips`. An IP is in use if a VM in the
+        design of one of *apps* refers to it. By default, the designs of all
+        applications are loaded. Free IPs in managed locations replace the
+        free IPs that the pool knows about. Afterwards, the pool is refilled.
+        No IPs are deleted. Returns a dict mapping locations to the number of
+        free IPs in excess of their high watermark.
+        """
+        locations = self._locations()
+        if eips is None:
+            eips = self._client.get_elastic_ips()
+        used = self._used(apps)
+        free = dict((loc, []) for loc in locations)
+        for eip in eips:
+            if eip.get('used') or eip.get('vmId') or eip.get('location') not in free:
+                continue
+            if _elastic_ip_address(eip) in used:
+                continue
+            free[eip['location']].append(eip)
+        with self._cond:
+            self._free.update(free)
+            self._cond.notify_all()
+        self.refill()
+        return dict((loc, max(0, len(free[loc]) - self.watermarks[loc][1]))
+                    for loc in locations)
+
+    def refill(self, location=None):
+        """Start creating IPs in *location* (or all locations) that are
+        below their low watermark."""
+        for loc in self._locations(location):
+            low, high = self.watermarks[loc]
+            with self._cond:
+                have = len(self._free.setdefault(loc, [])) + self._pending.get(loc, 0)
+                if have >= low:
+                    continue
+                count = high - have
+                self._pending[loc] = self._pending.get(loc, 0) + count
+            for i in range(count):
+                self._executor.submit(self._create, loc)
+
+    def release(self, location=None, adopted=False):
+        """Delete free IPs in *location* (or all locations) in excess of
+        their high watermark.
+
+        Only IPs that were created by the pool are deleted, unless *adopted*
+        is true, in which case IPs added by :meth:`reconcile` or :meth:`put`
+        are deleted as well.
+        """
+        for loc in self._locations(location):
+            high = self.watermarks[loc][1]
+            with self._cond:
+                free = self._free.setdefault(loc, [])
+                excess = []
+                for eip in reversed(free):
+                    if len(free) - len(excess) <= high:
+                        break
+                    if adopted or _elastic_ip_address(eip) in self._owned:
+                        excess.append(eip)
+                for eip in excess:
+                    free.remove(eip)
+                    self._owned.discard(_elastic_ip_address(eip))
+            for eip in excess:
+                self._executor.submit(self._delete, eip)
+
+    def _create(self, location):
+        client = self._client
+        try:
+            eip = client.create_elastic_ip(location)
+        except Exception as e:
+            client._logger.error('error creating elastic IP in {0}: {1!s}'.format(location, e))
+            eip = None
+        with self._cond:
+            self._pending[location] -= 1
+            if eip is not None:
+                self._free[location].append(eip)
+                self._owned.add(_elastic_ip_address(eip))
+            self._cond.notify_all()
+
+    def _delete(self, eip):
+        client = self._client
+        try:
+            client.delete_elastic_ip(_elastic_ip_address(eip))
+        except Exception as e:
+            client._logger.error('error deleting elastic IP {0}: {1!s}'
+                                 .format(_elastic_ip_address(eip), e))
+
+    def acquire(self, location, timeout=None):
+        """Hand out a free IP in *location*.
+
+        If no IP is free, wait for up to *timeout* seconds (or indefinitely)
+        for one, and raise a :class:`RavelloError` if none becomes free. The
+        pool is refilled in the background if needed. Returns the IP as
+        returned by :meth:`~RavelloClient.create_elastic_ip`.
+        """
+        self._locations(location)
+        end_time = time.time() + timeout if timeout is not None else None
+        retried = False
+        while True:
+            with self._cond:
+                free = self._free.setdefault(location, [])
+                while not free and self._pending.get(location):
+                    remaining = end_time - time.time() if end_time is not None else None
+                    if remaining is not None and remaining <= 0:
+                        raise RavelloError('no elastic IP free in {0}'.format(location))
+                    self._cond.wait(remaining)
+                if free:
+                    eip = free.pop(0)
+                    break
+                if retried:
+                    raise RavelloError('could not create an elastic IP in {0}'.format(location))
+            # Nothing is free or in progress. Create one even if the low
+            # watermark is zero.
+            with self._cond:
+                self._pending[location] = self._pending.get(location, 0) + 1
+            self._executor.submit(self._create, location)
+            retried = True
+        self.refill(location)
+        return eip
+
+    def put(self, eip, location=None):
+        """Return the IP *eip* to the pool.
+
+        The *location* defaults to the "location" key of *eip*. Excess IPs are
+        released.
+        """
+        if location is None:
+            location = eip['location']
+        self._locations(location)
+        with self._cond:
+            self._free.setdefault(location, []).append(eip)
+            self._cond.notify_all()
+        self.release(location)
+
+    def close(self, wait=False):
+        """Stop creating and deleting IPs. Free IPs are kept."""
+        self._executor.shutdown(wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
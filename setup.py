@@ -47,7 +47,9 @@ if __name__ == '__main__':
     setup(
         package_dir={'': 'lib'},
         py_modules=['ravello_sdk', 'ravello_cli'],
-        install_requires=['six', 'docopt', 'requests>=2.6.0'],
+        install_requires=['six', 'docopt', 'requests>=2.6.0',
+                          'futures; python_version < "3.0"'],
+        extras_require={'numpy': ['numpy']},
         scripts=['tools/ravello-create-nodes', 'tools/ravello-set-svm',
                    'tools/ravello-set-uuid'],
         **version_info
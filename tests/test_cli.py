@@ -0,0 +1,166 @@
+# Copyright 2012-2014 Ravello Systems, Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#    http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import, print_function
+
+import os
+import types
+import tempfile
+
+from support import *
+from ravello_cli import *
+from ravello_sdk import RavelloError
+
+
+def load_tool(name):
+    """Load the tool *name* from the tools directory as a module."""
+    testdir = os.path.split(os.path.abspath(__file__))[0]
+    path = os.path.join(os.path.split(testdir)[0], 'tools', name)
+    module = types.ModuleType(name.replace('-', '_'))
+    module.__file__ = path
+    with open(path) as fin:
+        code = compile(fin.read(), path, 'exec')
+    exec(code, module.__dict__)
+    return module
+
+
+class TestAddresses(UnitTest):
+
+    def test_inet(self):
+        self.assertEqual(inet_aton('10.1.2.3'), 0x0a010203)
+        self.assertEqual(inet_ntoa(0x0a010203), '10.1.2.3')
+        self.assertRaises(ValueError, inet_aton, '10.1.2')
+        self.assertEqual(parse_cidr('10.1.2.3/16'), ('10.1.0.0', '255.255.0.0'))
+
+    def test_mac(self):
+        self.assertEqual(mac_aton('2c:c2:60:00:01:ff'), 0x2cc2600001ff)
+        self.assertEqual(mac_ntoa(0x2cc2600001ff), '2c:c2:60:00:01:ff')
+        self.assertRaises(ValueError, mac_aton, '2c:c2:60')
+
+
+class TestAddressPool(UnitTest):
+
+    def test_allocate(self):
+        pool = AddressPool(10, 19)
+        pool.reserve([5, 11, 13, 14, 100])
+        self.assertEqual(pool.available, 7)
+        self.assertEqual(pool.allocate(3), [10, 12, 15])
+        self.assertEqual(pool.allocate(1), [16])
+        self.assertEqual(pool.available, 3)
+
+    def test_exhausted(self):
+        pool = AddressPool(0, 3)
+        pool.reserve([1])
+        self.assertRaises(ValueError, pool.allocate, 4)
+        self.assertEqual(pool.allocate(3), [0, 2, 3])
+        self.assertRaises(ValueError, pool.allocate, 1)
+
+    def test_design(self):
+        conn = {'device': {'mac': '2c:c2:60:00:00:01'},
+                'ipConfig': {'staticIpConfig': {'ip': '10.0.0.10'}}}
+        dhcp = {'device': {'useAutomaticMac': True},
+                'ipConfig': {'autoIpConfig': {'reservedIp': '10.0.0.11'}}}
+        design = {'vms': [{'networkConnections': [conn, dhcp]}, {}]}
+        macs, ips = get_design_addresses(design)
+        self.assertEqual(macs, set([0x2cc260000001]))
+        self.assertEqual(ips, set([0x0a00000a, 0x0a00000b]))
+
+
+class TestBulkTargets(UnitTest):
+
+    def test_match(self):
+        objs = [{'id': 1, 'name': 'web1'}, {'id': 2, 'name': 'web2'},
+                {'id': 3, 'name': 'db'}]
+        self.assertEqual(match_objects(objs, 'web*'), objs[:2])
+        self.assertEqual(match_objects(objs, '3'), objs[2:])
+        self.assertEqual(match_objects(objs, 'web[12]|db', regex=True), objs)
+        self.assertEqual(match_objects(objs, 'we', regex=True), [])
+
+    def test_read_targets(self):
+        fd, fname = tempfile.mkstemp(suffix='.csv')
+        try:
+            with os.fdopen(fd, 'w') as fout:
+                fout.write('# comment\nweb*,on\n\ndb/vm1\n')
+            targets = read_targets(fname)
+        finally:
+            os.remove(fname)
+        self.assertEqual(targets, [('web*', 'on'), ('db/vm1', None)])
+
+    def test_resolve_vms(self):
+        class Client(object):
+            def get_applications(self):
+                return [{'id': 1, 'name': 'web'}, {'id': 2, 'name': 'db'}]
+        targets = [('web/vm*', 'a'), ('*', 'b')]
+        resolved = resolve_vm_targets(Client(), targets)
+        self.assertEqual([app['id'] for app, _ in resolved], [1, 2])
+        self.assertEqual(resolved[0][1], [('vm*', 'a'), ('*', 'b')])
+        self.assertEqual(resolved[1][1], [('*', 'b')])
+        self.assertRaises(ValueError, resolve_vm_targets, Client(), [('x/y', None)])
+
+
+class TestDesignIndex(UnitTest):
+
+    design = {'vms': [{'id': 10, 'name': 'web', 'hostnames': ['web.local']},
+                      {'id': 11, 'name': '12', 'hostnames': ['db']},
+                      {'id': 12, 'name': 'dup'}, {'id': 13, 'name': 'dup'}]}
+
+    def test_get(self):
+        index = DesignIndex({'design': self.design})
+        vms = self.design['vms']
+        self.assertIs(index.get('web'), vms[0])
+        self.assertIs(index.get('web.local'), vms[0])
+        self.assertIs(index.get('10'), vms[0])
+        self.assertIs(index.get(10), vms[0])
+        self.assertIs(index.get('12'), vms[1])
+        self.assertIs(index.get('12', numeric=True), vms[2])
+        self.assertIsNone(index.get('nope'))
+        self.assertRaises(ValueError, index.get, 'dup')
+        self.assertRaises(KeyError, index.__getitem__, 'nope')
+        self.assertRaises(ValueError, get_design_vm, self.design, 'nope')
+
+    def test_select(self):
+        index = DesignIndex(self.design)
+        vms = self.design['vms']
+        self.assertEqual(index.select('dup'), vms[2:])
+        self.assertEqual(index.select('db'), vms[1:2])
+        self.assertEqual(index.select('13'), vms[3:])
+        self.assertEqual(index.select('12'), vms[1:3])
+        self.assertEqual(index.select('d*'), vms[1:])
+        self.assertEqual(index.select('w.b', regex=True), vms[:1])
+        self.assertEqual(index.select('x'), [])
+
+    def test_select_consistent(self):
+        vms = self.design['vms'] + [{'id': 14, 'name': 'db'}, {'id': 15, 'name': 'web.local'}]
+        index = DesignIndex({'vms': vms})
+        for pattern in ('web', 'web.local', 'db', 'dup', '10', '12', '012', 'x'):
+            self.assertEqual(index.select(pattern), match_objects(vms, pattern))
+
+
+class TestCreateNodes(UnitTest):
+
+    def setUp(self):
+        self.tool = load_tool('ravello-create-nodes')
+
+    def test_existing_application(self):
+        args = {'count': 3, 'per_app': 100, 'name': None,
+                'application': {'id': 1, 'name': 'app'}}
+        shards = self.tool.get_shards(None, args)
+        self.assertEqual([shard.name for shard in shards], ['app'])
+        exc = self.assertRaises(RavelloError, self.tool.check_provisioned, shards, [None])
+        self.assertIn('1 of 1 applications: app', str(exc))
+        self.tool.check_provisioned(shards, [{'id': 1}])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,814 @@
+# Copyright 2012-2014 Ravello Systems, Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#    http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import, print_function
+
+import os
+import copy
+import logging
+import time
+import shutil
+import tempfile
+import threading
+import requests
+
+from support import *
+from ravello_sdk import *
+from concurrent.futures import ThreadPoolExecutor
+
+
+class FakeClient(RavelloClient):
+    """A client that serves requests from an in-memory set of objects."""
+
+    def __init__(self, objects=None):
+        super(FakeClient, self).__init__()
+        self.objects = objects or {}
+        self.requests = []
+        self.conflicts = 0
+        # If not None, a dict mapping top-level objects to their version,
+        # which is returned as the entity tag.
+        self.versions = None
+
+    def _conflict(self, status):
+        response = requests.Response()
+        response.status_code = status
+        raise requests.exceptions.HTTPError('{0} Conflict'.format(status), response=response)
+
+    def _tagged(self, path, obj):
+        if self.versions is not None and isinstance(obj, dict):
+            obj['_etag'] = '"{0}"'.format(self.versions.get(path, 0))
+        return obj
+
+    def request(self, method, path, entity=None, headers=None):
+        self.requests.append((method, path))
+        if method == 'PUT' and self.conflicts:
+            self.conflicts -= 1
+            self._conflict(409)
+        if method == 'GET':
+            return self._tagged(path, copy.deepcopy(self.objects.get(path)))
+        elif method == 'PUT':
+            if self.versions is not None:
+                # Updating a VM updates the application it is part of.
+                top = '/'.join(path.split('/')[:3])
+                etag = dict(headers or []).get('If-Match')
+                if etag is not None and etag != self._tagged(top, {})['_etag']:
+                    self._conflict(412)
+                self.versions[top] = self.versions.get(top, 0) + 1
+            self.objects[path] = copy.deepcopy(entity)
+            return self._tagged(path, copy.deepcopy(entity))
+
+
+def make_application(nvms=3):
+    vms = [{'id': 100+i, 'name': 'vm{0}'.format(i)} for i in range(nvms)]
+    return {'id': 1, 'name': 'app', 'design': {'vms': vms}}
+
+
+class TestUpdateApplication(UnitTest):
+
+    def setUp(self):
+        self.client = FakeClient({'/applications/1': make_application()})
+
+    def test_unchanged(self):
+        app = self.client.get_application(1)
+        self.client.update_application(app)
+        self.assertEqual(self.client.requests, [('GET', '/applications/1')])
+
+    def test_single_vm(self):
+        app = self.client.get_application(1)
+        app['design']['vms'][1]['allowNested'] = True
+        updated = self.client.update_application(app)
+        self.assertEqual(self.client.requests[-1], ('PUT', '/applications/1/vms/101'))
+        self.assertTrue(updated['design']['vms'][1]['allowNested'])
+        self.client.update_application(updated)
+        self.assertEqual(len(self.client.requests), 2)
+
+    def test_full_update(self):
+        app = self.client.get_application(1)
+        app['name'] = 'renamed'
+        app['design']['vms'][0]['name'] = 'renamed'
+        self.client.update_application(app)
+        self.assertEqual(self.client.requests[-1], ('PUT', '/applications/1'))
+        app['design']['vms'].pop()
+        self.client.update_application(app)
+        self.assertEqual(self.client.requests[-1], ('PUT', '/applications/1'))
+
+    def test_reorder(self):
+        app = self.client.get_application(1)
+        app['design']['vms'][0]['disks'] = [{'id': 1}, {'id': 2}]
+        app = self.client.update_application(app)
+        app['design']['vms'][0]['disks'].reverse()
+        self.client.update_application(app)
+        self.assertEqual(self.client.requests[-1], ('PUT', '/applications/1/vms/100'))
+
+    def test_bounded(self):
+        self.client.max_fingerprints = 4
+        for appid in range(10):
+            self.client._track_application({'id': appid, 'design': {}})
+            self.client._fingerprint(0)
+        self.assertLessEqual(len(self.client._fingerprints), 4)
+        self.assertIsNotNone(self.client._fingerprint(0))
+        self.assertIsNotNone(self.client._fingerprint(9))
+        self.client.delete_application(9)
+        self.assertIsNone(self.client._fingerprint(9))
+
+    def test_force(self):
+        app = self.client.get_application(1)
+        self.client.update_application(app, only_changed=False)
+        self.assertEqual(self.client.requests[-1], ('PUT', '/applications/1'))
+
+    def test_chained(self):
+        app = self.client.get_application(1)
+        app['design']['vms'][1]['allowNested'] = True
+        app = self.client.update_application(app)
+        app['name'] = 'renamed'
+        self.client.update_application(app, only_changed=False)
+        self.assertEqual(self.client.requests[1:], [('PUT', '/applications/1/vms/101'),
+                                                    ('PUT', '/applications/1')])
+
+    def test_chained_etag(self):
+        self.client.versions = {}
+        app = self.client.get_application(1)
+        app['design']['vms'][1]['allowNested'] = True
+        app = self.client.update_application(app)
+        self.assertEqual(self.client.requests[-1], ('PUT', '/applications/1'))
+        app['design']['vms'][2]['allowNested'] = True
+        app = self.client.update_application(app)
+        self.client.update_application(app, only_changed=False)
+        self.assertEqual(self.client.versions['/applications/1'], 3)
+        self.client.versions['/applications/1'] += 1
+        self.assertRaises(RavelloConflictError, self.client.update_application, app,
+                          only_changed=False)
+
+
+class TestEditSession(UnitTest):
+
+    def setUp(self):
+        self.client = FakeClient({'/applications/1': make_application(),
+                                  '/images/2': {'id': 2, 'name': 'img'}})
+
+    def set_vm(self, ix, key, value):
+        def edit(app):
+            app['design']['vms'][ix][key] = value
+        return edit
+
+    def test_coalesce(self):
+        with self.client.edit_session() as session:
+            session.edit_application(1, self.set_vm(0, 'biosUuid', 'x'))
+            session.edit_application({'id': 1}, self.set_vm(1, 'allowNested', True))
+            session.edit_image(2, lambda img: dict(img, allowNested=True))
+            self.assertEqual(session.pending, 2)
+            self.assertEqual(self.client.requests, [])
+        self.assertEqual(self.client.requests, [('GET', '/applications/1'),
+                                                ('PUT', '/applications/1'),
+                                                ('GET', '/images/2'),
+                                                ('PUT', '/images/2')])
+        vms = self.client.objects['/applications/1']['design']['vms']
+        self.assertEqual(vms[0]['biosUuid'], 'x')
+        self.assertTrue(vms[1]['allowNested'])
+        self.assertTrue(self.client.objects['/images/2']['allowNested'])
+
+    def test_conflict(self):
+        self.client.conflicts = 1
+        session = self.client.edit_session()
+        session.edit_image(2, lambda img: dict(img, allowNested=True))
+        session.flush()
+        self.assertEqual(self.client.requests, [('GET', '/images/2'), ('PUT', '/images/2'),
+                                                ('GET', '/images/2'), ('PUT', '/images/2')])
+        self.assertEqual(session.pending, 0)
+
+    def test_conflict_retries(self):
+        self.client.conflicts = 5
+        session = self.client.edit_session(retries=2)
+        session.edit_image(2, lambda img: dict(img, allowNested=True))
+        self.assertRaises(RavelloConflictError, session.flush)
+        self.assertEqual(session.pending, 1)
+
+
+class TestModify(UnitTest):
+
+    def setUp(self):
+        self.client = FakeClient({'/applications/1': make_application()})
+
+    def rename(self, app):
+        app['name'] = 'renamed'
+
+    def test_modify(self):
+        self.client.conflicts = 2
+        app = self.client.modify_application(1, self.rename)
+        self.assertEqual(app['name'], 'renamed')
+        self.assertEqual(len(self.client.requests), 6)
+
+    def test_give_up(self):
+        self.client.conflicts = 2
+        self.assertRaises(RavelloConflictError, self.client.modify_application,
+                          1, self.rename, retries=2)
+        self.assertEqual(self.client.objects['/applications/1']['name'], 'app')
+
+    def test_precondition(self):
+        headers = []
+        self.client.request = lambda method, path, entity=None, hdrs=None: headers.append(hdrs)
+        self.client.update_image({'id': 2, '_etag': '"v1"'})
+        self.assertEqual(headers, [[('If-Match', '"v1"')]])
+
+
+class LoginClient(RavelloClient):
+    """A client that counts logins instead of performing them."""
+
+    logins = 0
+
+    def _login(self):
+        if self._password == 'bad':
+            raise RavelloError('login failed')
+        self._connection = requests.Session()
+        LoginClient.logins += 1
+
+
+class TestClientPool(UnitTest):
+
+    def setUp(self):
+        LoginClient.logins = 0
+        self.pool = ClientPool(maxsize=2)
+        self.pool.client_class = LoginClient
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_shared(self):
+        client = self.pool.get('user', 'pass')
+        self.assertTrue(client.logged_in)
+        self.assertIs(self.pool.get('user', 'pass'), client)
+        self.assertIsNot(self.pool.get('user', 'other'), client)
+        self.assertIsNot(self.pool.get(eph_token='token'), client)
+        self.assertEqual(LoginClient.logins, 3)
+        self.assertRaises(RuntimeError, self.pool.get, 'user')
+
+    def test_lru(self):
+        first = self.pool.get('user1', 'pass')
+        time.sleep(0.01)
+        self.pool.get('user2', 'pass')
+        time.sleep(0.01)
+        self.pool.get('user1', 'pass')
+        self.pool.get('user3', 'pass')
+        self.assertEqual(len(self.pool), 2)
+        self.assertIs(self.pool.get('user1', 'pass'), first)
+        self.pool.get('user2', 'pass')
+        self.assertEqual(LoginClient.logins, 4)
+
+    def test_failed_login(self):
+        self.assertRaises(RavelloError, self.pool.get, 'user', 'bad')
+        self.assertEqual(len(self.pool), 0)
+
+    def test_maintain(self):
+        self.pool.refresh = 0
+        self.pool.get('user', 'pass')
+        self.pool.maintain()
+        self.assertEqual(LoginClient.logins, 2)
+        self.pool.max_idle = 0
+        time.sleep(0.01)
+        self.pool.maintain()
+        self.assertEqual(len(self.pool), 0)
+
+
+class StoreClient(RavelloClient):
+    """A client that fakes the login request."""
+
+    logins = 0
+
+    def _request(self, method, path, body=b'', headers=None, connection=None):
+        response = requests.Response()
+        response.entity = None
+        if path == '/login':
+            StoreClient.logins += 1
+            connection.cookies.set('JSESSIONID', 'session{0}'.format(self.logins),
+                                         domain='cloud.ravellosystems.com', path='/')
+            response.entity = {'name': self._username}
+        return response
+
+
+class TestSessionStore(UnitTest):
+
+    def setUp(self):
+        StoreClient.logins = 0
+        self.directory = tempfile.mkdtemp()
+        self.store = SessionStore(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_store(self):
+        key = self.store.key('url', 'user')
+        self.assertIsNone(self.store.load(key))
+        self.store.save(key, {'user_info': 1})
+        self.assertEqual(self.store.load(key), {'user_info': 1})
+        if os.name == 'posix':
+            for name in (key + '.json', 'secret'):
+                mode = os.stat(os.path.join(self.directory, name)).st_mode
+                self.assertEqual(mode & 0o777, 0o600)
+        self.store.delete(key)
+        self.assertIsNone(self.store.load(key))
+
+    def test_key(self):
+        key = self.store.key('url', 'user')
+        self.assertEqual(SessionStore(self.directory).key('url', 'user'), key)
+        other = SessionStore(tempfile.mkdtemp())
+        self.assertNotEqual(other.key('url', 'user'), key)
+        shutil.rmtree(other.directory)
+        self.store.save(key, {'user_info': 1}, 'pass')
+        with open(os.path.join(self.directory, key + '.json')) as fin:
+            self.assertNotIn('pass"', fin.read())
+        self.assertEqual(self.store.load(key, 'pass'), {'user_info': 1})
+        self.assertIsNone(self.store.load(key, 'other'))
+
+    def test_resume(self):
+        client = StoreClient('user', 'pass', session_store=self.store)
+        client.login()
+        self.assertEqual(StoreClient.logins, 1)
+        client = StoreClient('user', 'pass', session_store=self.store)
+        client.login()
+        self.assertEqual(StoreClient.logins, 1)
+        self.assertEqual(client.user_info, {'name': 'user'})
+        self.assertEqual(client._connection.cookies['JSESSIONID'], 'session1')
+        StoreClient('user', 'other', session_store=self.store).login()
+        self.assertEqual(StoreClient.logins, 2)
+        client.logout()
+        StoreClient('user', 'pass', session_store=self.store).login()
+        self.assertEqual(StoreClient.logins, 3)
+
+
+class FakeServer(object):
+    """A server that only accepts requests with a current session cookie."""
+
+    def __init__(self):
+        self.sessions = set()
+        self.logins = 0
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def send(self, connection, request, **kwargs):
+        response = requests.Response()
+        response.headers['Content-Type'] = 'application/json'
+        response.encoding = 'utf-8'
+        response._content = b'{}'
+        response.status_code = 200
+        with self.lock:
+            self.requests += 1
+        if request.url.endswith('/login'):
+            with self.lock:
+                self.logins += 1
+                session = str(self.logins)
+                self.sessions.add(session)
+            time.sleep(0.01)
+            connection.cookies.set('session', session)
+        elif request.headers.get('Cookie', '')[len('session='):] not in self.sessions:
+            response.status_code = 401
+        return response
+
+
+class ServerClient(RavelloClient):
+    """A client that talks to a :class:`FakeServer`."""
+
+    def __init__(self, server, **kwargs):
+        super(ServerClient, self).__init__('user', 'pass', **kwargs)
+        self.server = server
+
+    def _new_connection(self):
+        connection = super(ServerClient, self)._new_connection()
+        connection.send = lambda request, **kwargs: \
+                self.server.send(connection, request, **kwargs)
+        return connection
+
+
+class TestRelogin(UnitTest):
+
+    def setUp(self):
+        self.server = FakeServer()
+
+    def test_expired(self):
+        client = ServerClient(self.server, retries=1)
+        client.login()
+        self.server.sessions.clear()
+        self.assertEqual(client.request('GET', '/applications'), {})
+        self.assertEqual(self.server.logins, 2)
+
+    def test_coordinated(self):
+        client = ServerClient(self.server)
+        client.login()
+        self.server.sessions.clear()
+        threads = [threading.Thread(target=client.request, args=('GET', '/applications'))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.server.logins, 2)
+
+    def test_refresh(self):
+        client = ServerClient(self.server)
+        self.assertFalse(client.refresh_due(0))
+        client.login()
+        self.assertFalse(client.refresh_due(60, 60))
+        self.assertTrue(client.refresh_due(0))
+        self.assertTrue(client.refresh_due(60, 0))
+        client.refresh_login()
+        self.assertEqual(self.server.logins, 2)
+        self.assertEqual(client.request('GET', '/applications'), {})
+
+
+class TestConnect(UnitTest):
+
+    def setUp(self):
+        self.server = FakeServer()
+
+    def test_warm(self):
+        client = ServerClient(self.server)
+        client.connect(warm=16, login=True)
+        self.assertEqual(self.server.requests, 17)
+        self.assertEqual(self.server.logins, 1)
+        self.assertTrue(client.logged_in)
+        adapter = client._connection.get_adapter(client.default_url)
+        self.assertIs(adapter, client._adapter)
+        self.assertEqual(client._pool_size, 16)
+        client.refresh_login()
+        self.assertIs(client._connection.get_adapter(client.default_url), adapter)
+
+    def test_probe(self):
+        client = ServerClient(self.server)
+        self.assertGreaterEqual(client.probe(), 0)
+        self.assertFalse(client.logged_in)
+
+
+class TestAsync(UnitTest):
+
+    def setUp(self):
+        self.client = FakeClient({'/applications/1': make_application(),
+                                  '/applications/2': make_application()})
+
+    def tearDown(self):
+        self.client.shutdown()
+
+    def test_gather(self):
+        fs = [self.client.get_application_async(appid) for appid in (1, 2, 3)]
+        apps = gather(fs)
+        self.assertEqual([app and app['name'] for app in apps], ['app', 'app', None])
+        self.assertEqual(len(list(as_completed(fs))), 3)
+
+    def test_exceptions(self):
+        self.client.conflicts = 1
+        app = self.client.get_application(1)
+        app['name'] = 'renamed'
+        fs = [self.client.update_application_async(app), self.client.get_application_async(2)]
+        self.assertRaises(RavelloConflictError, gather, fs)
+        results = gather(fs, return_exceptions=True)
+        self.assertIsInstance(results[0], RavelloConflictError)
+        self.assertEqual(results[1]['id'], 1)
+
+    def test_timeout(self):
+        fs = [self.client.executor.submit(time.sleep, 0.5)]
+        self.assertRaises(RavelloError, gather, fs, timeout=0.01)
+        self.assertRaises(RavelloError, list, as_completed(fs, timeout=0.01))
+
+
+class TestBatch(UnitTest):
+
+    def setUp(self):
+        self.client = FakeClient({'/applications/1': make_application(),
+                                  '/applications/2': make_application()})
+
+    def test_batch(self):
+        with self.client.batch(max_concurrency=2) as batch:
+            calls = [batch.get_application(appid) for appid in (1, 2)]
+            self.assertEqual(len(self.client.requests), 0)
+        self.assertEqual(len(self.client.requests), 2)
+        self.assertEqual([call.result['name'] for call in calls], ['app', 'app'])
+        self.assertRaises(AttributeError, getattr, batch, 'login')
+        self.assertRaises(AttributeError, getattr, batch, 'get_application_async')
+
+    def test_pool_size(self):
+        batch = self.client.batch(max_concurrency=32)
+        for i in range(32):
+            batch.get_application(1)
+        batch.run()
+        self.assertGreaterEqual(self.client._pool_size, 32)
+
+    def test_errors(self):
+        app = self.client.get_application(1)
+        app['name'] = 'renamed'
+        self.client.conflicts = 1
+        batch = self.client.batch(max_concurrency=1)
+        batch.update_application(app)
+        batch.get_application(2)
+        exc = self.assertRaises(BatchError, batch.run)
+        self.assertEqual(len(exc.failed), 1)
+        self.assertIsInstance(exc.failed[0].exception, RavelloConflictError)
+        self.assertEqual(exc.calls[1].result['id'], 1)
+        self.assertIn('update_application(1)', str(exc))
+
+    def test_fail_fast(self):
+        app = self.client.get_application(1)
+        app['name'] = 'renamed'
+        self.client.conflicts = 1
+        batch = self.client.batch(max_concurrency=1, fail_fast=True)
+        batch.update_application(app)
+        batch.get_application(2)
+        exc = self.assertRaises(BatchError, batch.run)
+        self.assertTrue(exc.calls[1].skipped)
+        self.assertIn('1 skipped', str(exc))
+
+
+class TestSetVmStates(UnitTest):
+
+    def test_set_vm_states(self):
+        vms = [{'id': 100+i, 'state': 'STOPPED'} for i in range(3)]
+        client = FakeClient({'/applications/1;deployment': {'id': 1, 'deployment': {'vms': vms}}})
+        plan = client.set_vm_states(1, {100: 'STARTED', 101: 'STARTED'}, max_concurrency=1)
+        self.assertEqual(len(plan.calls), 2)
+        self.assertEqual(client.requests, [('GET', '/applications/1;deployment'),
+                                           ('POST', '/applications/1/vms/100/start'),
+                                           ('POST', '/applications/1/vms/101/start')])
+        client.requests = []
+        client.set_vm_states(1, 'STARTED')
+        self.assertEqual(client.requests[1:], [('POST', '/applications/1/start')])
+
+
+class TestFleetSnapshot(UnitTest):
+
+    def test_get_fleet_snapshot(self):
+        vms = [{'id': 100, 'state': 'STARTED'}]
+        client = FakeClient({'/applications': [{'id': 1, 'name': 'app', 'published': True},
+                                               {'id': 2, 'name': 'gone', 'published': True},
+                                               {'id': 3, 'name': 'draft'}],
+                             '/applications/1;deployment': {'id': 1, 'deployment': {'vms': vms}}})
+        snapshot = client.get_fleet_snapshot(max_concurrency=2)
+        self.assertEqual(len(client.requests), 3)
+        self.assertEqual(list(snapshot.by_application), [1])
+        self.assertEqual(snapshot.by_id[1, 100].app_name, 'app')
+
+
+    def test_get_fleet_table(self):
+        vms = [{'id': 100, 'name': 'vm', 'state': 'STARTED', 'numCpus': 2}]
+        client = FakeClient({'/applications': [{'id': 1, 'name': 'app', 'published': True}],
+                             '/applications/1;deployment': {'id': 1, 'deployment': {'vms': vms}},
+                             '/billing': [{'appId': 1, 'charges': [{'charge': 2.5}]}]})
+        table = client.get_fleet_table()
+        self.assertEqual(table.sum_by('app', 'charges'), {'app': 2.5})
+
+
+class TestBulkVms(UnitTest):
+
+    def setUp(self):
+        image = {'id': 5, 'name': 'web', 'owner': 'me', 'hostnames': ['web'],
+                 'networkConnections': [{'id': 7, 'device': {'id': 8}}]}
+        self.client = FakeClient({'/applications/1': make_application(),
+                                  '/images/5': image})
+
+    def test_add(self):
+        app = self.client.add_library_vms(1, [(5, 3, None), (5, 1, {'name': 'db'})],
+                                          publish=True)
+        self.assertEqual([req[0] for req in self.client.requests],
+                         ['GET', 'GET', 'PUT', 'POST'])
+        vms = app['design']['vms'][3:]
+        self.assertEqual([vm['name'] for vm in vms], ['web-0', 'web-1', 'web-2', 'db-0'])
+        ids = set(vm.get('id') for vm in app['design']['vms'])
+        self.assertEqual(len(ids), 7)
+        self.assertNotIn(None, ids)
+        self.assertNotIn(5, ids)
+        self.assertEqual(vms[1]['hostnames'], ['web-1'])
+        self.assertEqual(vms[0]['baseVmId'], 5)
+        self.assertNotIn('owner', vms[0])
+        luids = set(vm['networkConnections'][0]['id'] for vm in vms)
+        self.assertEqual(len(luids), 4)
+        self.assertNotIn(7, luids)
+
+    def test_remove(self):
+        app = self.client.remove_vms(1, [100, {'id': 102}])
+        self.assertEqual([vm['id'] for vm in app['design']['vms']], [101])
+        self.assertEqual(len(self.client.requests), 2)
+        self.assertRaises(RavelloError, self.client.remove_vms, 1, [103])
+
+
+class PoolClient(object):
+    """A client that publishes applications instantly."""
+
+    def __init__(self, apps=()):
+        self.apps = dict((app['id'], app) for app in apps)
+        self.calls = []
+        self.lock = threading.Lock()
+        self.count = 0
+        self._logger = logging.getLogger('ravello')
+
+    def get_applications(self):
+        with self.lock:
+            return [dict(app) for app in self.apps.values()]
+
+    def create_application(self, app):
+        with self.lock:
+            self.count += 1
+            app = dict(app, id=self.count)
+            self.apps[app['id']] = app
+        return app
+
+    def publish_application(self, app, req):
+        self.calls.append(('publish', app['id'], req['startAllVms']))
+        self.apps[app['id']]['started'] = req['startAllVms']
+
+    def wait_for(self, app, cond, timeout):
+        vms = [{'state': 'STARTED' if self.apps[app['id']]['started'] else 'STOPPED'}]
+        if not cond(dict(app, deployment={'vms': vms})):
+            raise RavelloError('timeout waiting for condition')
+
+    def set_application_expiration(self, app, req):
+        self.calls.append(('expire', app['id'], req['expirationFromNowSeconds']))
+
+    def get_application(self, app):
+        app = self.apps.get(app['id'])
+        if app is None:
+            return
+        vms = [{'state': 'STARTED' if app.get('started') else 'STOPPED'}]
+        return dict(app, deployment={'vms': vms})
+
+    def update_application(self, app):
+        self.apps[app['id']] = dict(app)
+        return app
+
+    def delete_application(self, app):
+        self.calls.append(('delete', app['id']))
+        del self.apps[app['id']]
+
+
+class TestApplicationPool(UnitTest):
+
+    def test_pool(self):
+        client = PoolClient()
+        pool = ApplicationPool(client, {5: 2}, expiration=600)
+        with pool:
+            pool.replenish()
+            pool._executor.shutdown(True)
+        self.assertEqual(pool.ready(5), 2)
+        self.assertEqual(sorted(app['name'] for app in client.apps.values()),
+                         ['pool-5-0', 'pool-5-1'])
+        self.assertIn(('expire', 1, 600), client.calls)
+        self.assertIn(('publish', 1, True), client.calls)
+        pool._executor = ThreadPoolExecutor(1)
+        app = pool.acquire(5, name='lab1', timeout=1)
+        self.assertEqual(app['name'], 'lab1')
+        pool.close(True)
+        self.assertEqual(pool.ready(5), 2)
+
+    def test_adopt(self):
+        apps = [{'id': 98, 'name': 'pool-5-0', 'published': True,
+                 'description': ApplicationPool.acquired},
+                {'id': 99, 'name': 'pool-5-1', 'published': True,
+                 'description': ApplicationPool.description}]
+        client = PoolClient(apps)
+        pool = ApplicationPool(client, {5: 1, 6: 1}, state='STOPPED')
+        pool.adopt()
+        self.assertEqual(pool.ready(5), 1)
+        self.assertEqual(pool.acquire(5)['id'], 99)
+        self.assertEqual(client.apps[99]['description'], ApplicationPool.acquired)
+        # A new pool does not take back the acquired applications.
+        other = ApplicationPool(client, {5: 2})
+        other.adopt()
+        self.assertEqual(other.ready(5), 0)
+        other.close()
+        self.assertEqual(pool.acquire(6, timeout=1)['baseBlueprintId'], 6)
+        self.assertRaises(RavelloError, pool.acquire, 5, owner='user', timeout=1)
+        pool.close(True)
+        self.assertEqual(pool.ready(6), 1)
+
+    def test_stale(self):
+        desc = ApplicationPool.description
+        apps = [{'id': 97, 'name': 'pool-5-0', 'started': True},
+                {'id': 98, 'name': 'pool-5-1', 'started': False},
+                {'id': 99, 'name': 'pool-5-2', 'started': True}]
+        for app in apps:
+            app.update(description=ApplicationPool.description, published=True)
+        client = PoolClient(apps)
+        pool = ApplicationPool(client, {5: 3})
+        pool.adopt()
+        del client.apps[97]
+        # The deleted application is skipped and the expired one discarded.
+        self.assertEqual(pool.acquire(5, timeout=1)['id'], 99)
+        self.assertIn(('delete', 98), client.calls)
+        self.assertNotIn(98, client.apps)
+        err = self.assertRaises(RavelloError, pool.acquire, 6)
+        self.assertIn('not managed', str(err))
+        pool.close(True)
+
+
+class EipClient(object):
+    """A client that manages elastic IPs in memory."""
+
+    def __init__(self, eips=(), apps=()):
+        self.eips = list(eips)
+        self.apps = list(apps)
+        self.lock = threading.Lock()
+        self.count = 0
+        self._logger = logging.getLogger('ravello')
+
+    def get_elastic_ip_locations(self):
+        return [{'name': 'us-east'}, {'name': 'eu-west'}]
+
+    def get_elastic_ips(self):
+        return list(self.eips)
+
+    def get_applications(self):
+        return [{'id': app['id']} for app in self.apps]
+
+    def get_application(self, app, aspect=None):
+        assert aspect == 'design'
+        for full in self.apps:
+            if full['id'] == app['id']:
+                return full
+
+    def create_elastic_ip(self, location):
+        with self.lock:
+            self.count += 1
+            eip = {'ip': '10.0.0.{0}'.format(self.count), 'location': location}
+            self.eips.append(eip)
+        return eip
+
+    def delete_elastic_ip(self, ip):
+        with self.lock:
+            self.eips = [eip for eip in self.eips if eip['ip'] != ip]
+
+
+class TestElasticIpPool(UnitTest):
+
+    def test_refill(self):
+        client = EipClient()
+        pool = ElasticIpPool(client, (1, 3))
+        pool.refill()
+        pool.close(True)
+        self.assertEqual(pool.available('us-east'), 3)
+        self.assertEqual(pool.available('eu-west'), 3)
+        pool._executor = ThreadPoolExecutor(1)
+        for i in range(2):
+            pool.acquire('us-east')
+        self.assertEqual(len(client.eips), 6)
+        pool.acquire('us-east')
+        pool.close(True)
+        self.assertEqual(pool.available('us-east'), 3)
+        self.assertRaises(RavelloError, pool.acquire, 'nowhere')
+
+    def test_reconcile(self):
+        eips = [{'ip': '1.1.1.{0}'.format(i), 'location': 'us-east'} for i in range(5)]
+        eips.append({'ip': '1.1.1.9', 'location': 'us-east', 'vmId': 1})
+        client = EipClient(eips)
+        pool = ElasticIpPool(client, {'us-east': (0, 2)})
+        self.assertEqual(pool.reconcile(), {'us-east': 3})
+        pool.release()
+        pool.close(True)
+        # Adopted IPs are only deleted on request.
+        self.assertEqual(pool.available('us-east'), 5)
+        self.assertEqual(len(client.eips), 6)
+        pool._executor = ThreadPoolExecutor(1)
+        pool.release(adopted=True)
+        pool.close(True)
+        self.assertEqual(pool.available('us-east'), 2)
+        self.assertEqual(len(client.eips), 3)
+
+    def test_reconcile_in_use(self):
+        eips = [{'ip': '1.1.1.{0}'.format(i), 'location': 'us-east'} for i in range(3)]
+        conn = {'ipConfig': {'elasticIpAddress': '1.1.1.1'}}
+        apps = [{'id': 1, 'design': {'vms': [{'networkConnections': [conn]}]}}]
+        client = EipClient(eips, apps)
+        pool = ElasticIpPool(client, {'us-east': (0, 3)})
+        self.assertEqual(pool.reconcile(), {'us-east': 0})
+        ips = [pool.acquire('us-east', timeout=0)['ip'] for i in range(2)]
+        self.assertEqual(sorted(ips), ['1.1.1.0', '1.1.1.2'])
+        self.assertRaises(RavelloError, pool.acquire, 'us-east', timeout=0)
+        pool.close(True)
+
+    def test_release_owned(self):
+        client = EipClient([{'ip': '1.1.1.1', 'location': 'us-east'}])
+        pool = ElasticIpPool(client, {'us-east': (1, 1)})
+        pool.reconcile()
+        eip = pool.acquire('us-east')
+        pool.close(True)
+        self.assertEqual(eip['ip'], '1.1.1.1')
+        self.assertEqual(pool.available('us-east'), 1)
+        pool._executor = ThreadPoolExecutor(1)
+        pool.put(eip)
+        pool.close(True)
+        self.assertEqual([eip['ip'] for eip in client.eips], ['1.1.1.1'])
+        self.assertEqual(pool.available('us-east'), 1)
+
+    def test_acquire_empty(self):
+        pool = ElasticIpPool(EipClient(), {'us-east': (0, 0)})
+        self.assertEqual(pool.acquire('us-east', timeout=1)['location'], 'us-east')
+        pool.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -15,6 +15,7 @@
 from __future__ import absolute_import, print_function
 
 from support import *
+import ravello_sdk
 from ravello_sdk import *
 
 
@@ -39,5 +40,202 @@ class TestNewName(UnitTest):
         self.assertNotIn(new, names)
 
 
+class TestNameAllocator(UnitTest):
+
+    def test_gaps(self):
+        names = ['vm0', 'vm2', 'vm3', 'vm01', 'vm', 'other5', {'name': 'vm5'}]
+        allocator = NameAllocator(names, 'vm')
+        self.assertEqual(allocator.allocate(), 'vm1')
+        self.assertEqual(allocator.allocate(3), ['vm4', 'vm6', 'vm7'])
+
+    def test_reserve(self):
+        allocator = NameAllocator([], 'vm-')
+        allocator.reserve('vm-0')
+        self.assertEqual(allocator.allocate(2), ['vm-1', 'vm-2'])
+
+    def test_bulk(self):
+        names = ['vm{0}'.format(i) for i in range(0, 20000, 2)]
+        new = NameAllocator(names, 'vm').allocate(10000)
+        self.assertEqual(len(set(new) | set(names)), 20000)
+
+
+class TestFingerprint(UnitTest):
+
+    def test_key_order_insensitive(self):
+        a = {'name': 'app', 'design': {'vms': [{'id': 1, 'x': 1}, {'id': 2}]}}
+        b = {'design': {'vms': [{'x': 1, 'id': 1}, {'id': 2}]}, 'name': 'app'}
+        self.assertEqual(fingerprint(a), fingerprint(b))
+
+    def test_entity_lists_ordered(self):
+        a = {'hardDrives': [{'id': 1, 'index': 0}, {'id': 2, 'index': 1}]}
+        b = {'hardDrives': [{'id': 2, 'index': 1}, {'id': 1, 'index': 0}]}
+        self.assertNotEqual(fingerprint(a), fingerprint(b))
+
+    def test_scalar_lists_ordered(self):
+        a = {'bootOrder': ['CDROM', 'DISK']}
+        b = {'bootOrder': ['DISK', 'CDROM']}
+        self.assertNotEqual(fingerprint(a), fingerprint(b))
+
+    def test_ignore(self):
+        a = {'id': 1, 'name': 'foo', '_href': '/applications/1'}
+        b = {'id': 1, 'name': 'foo', 'version': 10}
+        self.assertEqual(fingerprint(a), fingerprint(b))
+        self.assertNotEqual(fingerprint(a), fingerprint({'id': 1, 'name': 'bar'}))
+
+    def test_application(self):
+        app = {'id': 1, 'design': {'vms': [{'id': 10, 'name': 'vm0'},
+                                           {'id': 11, 'name': 'vm1'}]},
+               'deployment': {'vms': [{'state': 'STARTED'}]}}
+        fp1 = fingerprint_application(app)
+        self.assertEqual(set(fp1.vms), set([10, 11]))
+        app['deployment']['vms'][0]['state'] = 'STOPPED'
+        self.assertEqual(fingerprint_application(app), fp1)
+        app['design']['vms'][1]['name'] = 'vm2'
+        fp2 = fingerprint_application(app)
+        self.assertNotEqual(fp2.digest, fp1.digest)
+        self.assertEqual(fp2.changed_vms(fp1), set([11]))
+
+
+class TestCloneLuids(UnitTest):
+
+    vm = {'id': 1, 'name': 'vm', 'hardDrives': [{'id': 2, 'size': 10}],
+          'networkConnections': [{'id': 3, 'ipConfig': {'id': 4}}],
+          'bootOrder': ['DISK']}
+
+    def luids(self, obj):
+        if isinstance(obj, list):
+            return sum([self.luids(elem) for elem in obj], [])
+        elif isinstance(obj, dict):
+            return sum([[v] if k == 'id' else self.luids(v) for k, v in obj.items()], [])
+        return []
+
+    def test_update_luids(self):
+        vm = {'id': 1, 'hardDrives': [{'id': 2}]}
+        self.assertIs(update_luids(vm), vm)
+
+    def test_clone(self):
+        clone = clone_with_new_luids(self.vm)
+        self.assertEqual(clone['hardDrives'][0]['size'], 10)
+        self.assertEqual(clone['bootOrder'], ['DISK'])
+        self.assertIsNot(clone['bootOrder'], self.vm['bootOrder'])
+        self.assertEqual(self.luids(self.vm), [1, 2, 3, 4])
+        self.assertTrue(set(self.luids(clone)).isdisjoint([1, 2, 3, 4]))
+
+    def test_unique(self):
+        design = {'vms': [{'id': 5}]}
+        clones = clone_with_new_luids(self.vm, count=50, exclude=design)
+        self.assertEqual(len(clones), 50)
+        luids = self.luids(clones)
+        self.assertEqual(len(luids), 200)
+        self.assertEqual(len(set(luids + [1, 2, 3, 4, 5])), 205)
+
+
+class TestPlanVmStates(UnitTest):
+
+    def deployment(self, *states):
+        vms = [{'id': 10+i, 'state': state} for i, state in enumerate(states)]
+        return {'id': 1, 'deployment': {'vms': vms}}
+
+    def test_collapse(self):
+        app = self.deployment('STOPPED', 'STOPPED', 'STARTING')
+        plan = plan_vm_states(app, 'STARTED')
+        self.assertEqual(plan.calls, [('start_application', (1,))])
+        self.assertEqual(plan.skipped, [12])
+        plan = plan_vm_states(app, {10: 'STARTED', '11': 'STARTED'})
+        self.assertEqual(plan.calls, [('start_application', (1,))])
+
+    def test_per_vm(self):
+        app = self.deployment('STOPPED', 'STOPPED', 'STOPPED')
+        plan = plan_vm_states(app, {10: 'STARTED', 11: 'STARTED'})
+        self.assertEqual(plan.calls, [('start_vm', (1, 10)), ('start_vm', (1, 11))])
+        app = self.deployment('STOPPED', 'STARTED', 'STARTED')
+        plan = plan_vm_states(app, {10: 'STARTED', 11: 'STOPPED'})
+        self.assertEqual(plan.calls, [('start_vm', (1, 10)), ('stop_vm', (1, 11))])
+
+    def test_blocked(self):
+        app = self.deployment('STARTED', 'STOPPING', 'ERROR')
+        plan = plan_vm_states(app, 'STARTED')
+        self.assertEqual(plan.calls, [])
+        self.assertEqual(plan.skipped, [10])
+        self.assertEqual(plan.blocked, {11: 'STOPPING', 12: 'ERROR'})
+        self.assertRaises(ValueError, plan_vm_states, app, 'RUNNING')
+        self.assertRaises(ValueError, plan_vm_states, app, {13: 'STARTED'})
+
+
+class TestFleetSnapshot(UnitTest):
+
+    def test_snapshot(self):
+        conn = lambda ip, fqdn: {'ipConfig': {'publicIp': ip, 'fqdn': fqdn}}
+        vms = [{'id': 100, 'name': 'web', 'state': 'STARTED',
+                'networkConnections': [conn('1.1.1.1', 'web.example.com'),
+                                       conn('1.1.1.2', None)]},
+               {'id': 101, 'name': 'db', 'state': 'STOPPED', 'externalFqdn': 'db.example.com'}]
+        apps = [{'id': 1, 'name': 'app', 'deployment': {'vms': vms}},
+                {'id': 2, 'name': 'empty'}]
+        snapshot = FleetSnapshot(apps)
+        self.assertEqual(len(snapshot), 2)
+        self.assertEqual(snapshot.by_ip['1.1.1.2'].name, 'web')
+        self.assertEqual(snapshot.by_id[1, 100].public_ips, ['1.1.1.1', '1.1.1.2'])
+        self.assertEqual(snapshot.by_fqdn['web.example.com'].id, 100)
+        self.assertEqual(snapshot.by_fqdn['db.example.com'].state, 'STOPPED')
+        self.assertEqual([vm.id for vm in snapshot.by_state['STARTED']], [100])
+        self.assertEqual(snapshot.by_application[2], [])
+        self.assertEqual(snapshot.states(), {'STARTED': 1, 'STOPPED': 1})
+
+
+class TestFleetTable(UnitTest):
+
+    def make_apps(self):
+        def vm(name, state, cpus):
+            return {'name': name, 'state': state, 'numCpus': cpus,
+                    'memorySize': {'value': 2, 'unit': 'GB'},
+                    'hardDrives': [{'size': {'value': 20, 'unit': 'GB'}},
+                                   {'size': {'value': 512, 'unit': 'MB'}}]}
+        return [{'id': 1, 'name': 'web', 'deployment': {
+                    'cloud': 'AMAZON', 'regionName': 'Virginia',
+                    'vms': [vm('a', 'STARTED', 2), vm('b', 'STOPPED', 4)]}},
+                {'id': 2, 'name': 'db', 'deployment': {
+                    'cloud': 'GOOGLE', 'regionName': 'Iowa',
+                    'vms': [vm('a', 'STARTED', 8)]}}]
+
+    def test_table(self):
+        modes = [False] + ([True] if ravello_sdk.numpy is not None else [])
+        billing = [{'appId': 1, 'charges': [{'charge': 3.0}, {'charge': 1.0}]}]
+        for use_numpy in modes:
+            table = FleetTable(self.make_apps(), billing, use_numpy=use_numpy)
+            self.assertEqual(len(table), 3)
+            self.assertEqual(table.categories['vm'], ['a', 'b'])
+            self.assertEqual(list(table.columns['vm']), [0, 1, 0])
+            self.assertEqual(table.column('cloud'), ['AMAZON', 'AMAZON', 'GOOGLE'])
+            self.assertEqual(table.column('memory'), [2048] * 3)
+            self.assertEqual(table.column('disk'), [20] * 3)
+            self.assertEqual(table.count_by('state'), {'STARTED': 2, 'STOPPED': 1})
+            self.assertEqual(table.sum_by('app', 'cpus'), {'web': 6, 'db': 8})
+            self.assertEqual(table.sum_by('region', 'charges'), {'Virginia': 4.0, 'Iowa': 0.0})
+            self.assertEqual(table.count_by(('cloud', 'state')),
+                             {('AMAZON', 'STARTED'): 1, ('AMAZON', 'STOPPED'): 1,
+                              ('GOOGLE', 'STARTED'): 1})
+
+    @unittest.skipIf(ravello_sdk.numpy is None, 'numpy is not installed')
+    def test_numpy(self):
+        apps = self.make_apps() * 50
+        for i, app in enumerate(apps):
+            app['id'] = i
+            app['name'] = 'app{0}'.format(i)
+        billing = dict((i, float(i)) for i in range(len(apps)))
+        tables = [FleetTable(apps, billing, use_numpy=use_numpy) for use_numpy in (False, True)]
+        for keys in ('state', ('app', 'vm'), ('cloud', 'region', 'state')):
+            self.assertEqual(tables[0].count_by(keys), tables[1].count_by(keys))
+            for column in ('cpus', 'memory', 'charges'):
+                self.assertEqual(tables[0].sum_by(keys, column), tables[1].sum_by(keys, column))
+        records = tables[1].to_records()
+        self.assertEqual(list(records['cpus']), tables[0].column('cpus'))
+
+    def test_empty(self):
+        table = FleetTable([], use_numpy=False)
+        self.assertEqual(len(table), 0)
+        self.assertEqual(table.count_by('state'), {})
+
+
 if __name__ == '__main__':
     unittest.main()